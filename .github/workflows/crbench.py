@@ -0,0 +1,508 @@
+import json
+import argparse
+import subprocess
+import sys
+import random
+import shutil
+import tempfile
+import platform
+from os import path, makedirs, wait4, environ, walk
+from statistics import median
+from time import perf_counter, time, sleep, strftime, gmtime
+from urllib.parse import parse_qs, urlsplit
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Benchmarks for crgen.py.
+#
+#   python crbench.py startup [--runs N] [--json FILE]
+#   python crbench.py suite [--sizes 100,1000] [--apps 20] [--json FILE] [--baseline FILE]
+#
+# startup measures, per subcommand, the wall time of a fresh interpreter that imports crgen,
+# parses the subcommand's arguments and imports what that subcommand needs (crgen.COMMAND_IMPORTS).
+# "eager" is every dependency at once, which is what every mode used to pay.
+#
+# suite runs crgen.py imageupdate, deploy and merge end to end as subprocesses: imageupdate against
+# generated GitOps trees, deploy and merge against local fake ArgoCD and GitHub servers with scripted
+# latency, sync durations and health. Each scenario reports wall time, files parsed and written,
+# HTTP requests and peak RSS. Results can be saved as JSON and compared against a saved baseline.
+
+dir_path = path.dirname(path.realpath(__file__))
+crgen_path = path.join(dir_path, "crgen.py")
+
+STARTUP_SCRIPT = """
+import sys, importlib
+sys.path.insert(0, {dir_path!r})
+import crgen
+command = {command!r}
+if command == "eager":
+    modules = sorted(set( m for ms in crgen.COMMAND_IMPORTS.values() for m in ms ))
+else:
+    crgen.build_parser().parse_known_args([ command ])
+    modules = crgen.COMMAND_IMPORTS[command]
+for module in modules:
+    importlib.import_module(module)
+"""
+
+def time_process(argv):
+    # Wall time of one interpreter run, in milliseconds.
+    start = perf_counter()
+    subprocess.run(argv, check = True, stdout = subprocess.DEVNULL)
+    return (perf_counter() - start) * 1000
+
+def startup_benchmark(runs):
+    sys.path.insert(0, dir_path)
+    import crgen
+
+    results = { "python": median( time_process([ sys.executable, "-c", "pass" ]) for _ in range(runs) ) }
+    for command in list(crgen.COMMAND_IMPORTS.keys()) + [ "eager" ]:
+        script = STARTUP_SCRIPT.format(dir_path = dir_path, command = command)
+        results[command] = median( time_process([ sys.executable, "-c", script ]) for _ in range(runs) )
+    return results
+
+def print_startup(results):
+    print(f"{'subcommand':<16}{'median ms':>10}{'over python':>13}")
+    for command, ms in results.items():
+        print(f"{command:<16}{ms:>10.1f}{ms - results['python']:>13.1f}")
+    return
+
+
+def generate_tree(root, files, depth = 3, density = 0.3, seed = 1):
+    # A synthetic GitOps checkout: files spread over depth levels of service/environment folders.
+    # density is the share of manifests that carry image.tag; the rest are unrelated yaml,
+    # with every tenth file non-yaml noise.
+    rng = random.Random(seed)
+    for i in range(files):
+        folders = [ f"svc{i % 50}" ] + [ f"level{d}-{rng.randrange(4)}" for d in range(depth - 1) ]
+        folder = path.join(root, "apps", *folders)
+        makedirs(folder, exist_ok = True)
+        if i % 10 == 9:
+            with open(path.join(folder, f"README-{i}.md"), "w") as f:
+                f.write("# notes\n")
+            continue
+        with open(path.join(folder, f"values-{i}.yaml"), "w") as f:
+            f.write(f"# generated manifest {i}\nreplicaCount: {rng.randrange(1, 5)}\n")
+            if rng.random() < density:
+                f.write(f"image:\n  repository: registry.example.com/svc{i % 50}\n  tag: v1.0.{i}  # pinned\n")
+            else:
+                f.write("service:\n  type: ClusterIP\n  port: 8080\n")
+            f.write("resources:\n  limits:\n    cpu: 500m\n    memory: 256Mi\n")
+    return
+
+
+class fake_server:
+    # A local HTTP server on a free port, run on a background thread. Subclasses route requests.
+    # Every request is counted per "METHOD path" and delayed by latency seconds.
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+        self.counts = {}
+        self.lock = Lock()
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *message):
+                return
+
+            def do_GET(self):
+                server.dispatch(self, "GET")
+
+            def do_POST(self):
+                server.dispatch(self, "POST")
+
+            def do_PUT(self):
+                server.dispatch(self, "PUT")
+
+            def do_DELETE(self):
+                server.dispatch(self, "DELETE")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        Thread(target = self.httpd.serve_forever, daemon = True).start()
+        return
+
+    def dispatch(self, request, method):
+        request_path = request.path.split("?")[0]
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            request.rfile.read(length)
+        with self.lock:
+            key = f"{method} {request_path}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+        if self.latency:
+            sleep(self.latency)
+        self.route(request, method, request_path)
+        return
+
+    def send(self, request, code, body = None, headers = {}):
+        data = json.dumps(body).encode() if body is not None else b""
+        request.send_response(code)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(data)
+        return
+
+    def requests(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+        return
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
+
+class fake_argocd(fake_server):
+    # Applications app0..appN-1 sourced from repo, annotated with sync wave i % waves. A sync keeps an app
+    # Progressing for sync_seconds, then it turns Healthy, or Degraded for the apps listed in degraded.
+    # The apps listed in broken start out Degraded with a failed operation, until a sync fixes them.
+    # Rollbacks and terminated operations are counted in rollbacks and terminated.
+    WAVE_KEY = "argocd.argoproj.io/sync-wave"
+
+    def __init__(self, apps, repo, sync_seconds = 1.0, degraded = (), latency = 0.0, stream = True, waves = 1, broken = ()):
+        self.apps = { f"app{i}": None for i in range(apps) }
+        self.waves = waves
+        self.rollbacks = []
+        self.terminated = []
+        self.repo = repo
+        self.sync_seconds = sync_seconds
+        self.degraded = set(degraded)
+        self.broken = set(broken)
+        self.stream = stream
+        super().__init__(latency)
+        return
+
+    def app_json(self, name):
+        # Like the real controller, a sync sits queued in "operation" for a moment first, while the app
+        # still shows the previous operation's state.
+        started = self.apps[name]
+        pickup = min(0.2, self.sync_seconds / 4)
+        operation, started_at = None, "2026-01-01T00:00:00Z"
+        before = ("Synced", "Degraded", "Failed") if name in self.broken else ("Synced", "Healthy", "Succeeded")
+        if started is not None and time() - started < pickup:
+            operation = { "sync": {} }
+            sync, health, phase = before
+        elif started is not None:
+            started_at = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime(started + pickup))
+            if time() - started < self.sync_seconds:
+                sync, health, phase = "OutOfSync", "Progressing", "Running"
+            else:
+                sync, health, phase = "Synced", "Degraded" if name in self.degraded else "Healthy", "Succeeded"
+        else:
+            sync, health, phase = before
+        app = {
+            "metadata": { "name": name, "labels": {}, "annotations": { self.WAVE_KEY: str(int(name[3:]) % self.waves) } },
+            "spec": { "project": "default", "source": { "repoURL": f"https://github.com/example/{self.repo}.git" } },
+            "status": {
+                "sync": { "status": sync },
+                "health": { "status": health },
+                "operationState": { "phase": phase, "startedAt": started_at },
+                "history": [ { "id": 1, "revision": "previous" } ],
+                "resources": [ { "kind": "Deployment", "name": name, "health": { "status": health } } ]
+            }
+        }
+        if operation is not None:
+            app['operation'] = operation
+        return app
+
+    def route(self, request, method, request_path):
+        parts = request_path.strip("/").split("/")
+        if method == "GET" and request_path == "/api/v1/applications":
+            return self.send(request, 200, { "items": [ self.app_json(name) for name in self.apps ] })
+        if method == "GET" and request_path == "/api/v1/stream/applications" and self.stream:
+            # name is a single string in ApplicationQuery; the gateway only uses the first one given.
+            names = parse_qs(urlsplit(request.path).query).get('name')
+            return self.watch(request, names[:1] if names else list(self.apps))
+        if len(parts) >= 4 and parts[:3] == [ "api", "v1", "applications" ] and parts[3] in self.apps:
+            name = parts[3]
+            if method == "POST" and parts[4:] == [ "sync" ]:
+                app = self.app_json(name)
+                self.apps[name] = time()
+                return self.send(request, 200, app)
+            if method == "POST" and parts[4:] == [ "rollback" ]:
+                self.rollbacks.append(name)
+                self.apps[name] = None
+                return self.send(request, 200, self.app_json(name))
+            if method == "DELETE" and parts[4:] == [ "operation" ]:
+                self.terminated.append(name)
+                return self.send(request, 200, {})
+            if method == "GET" and len(parts) == 4:
+                return self.send(request, 200, self.app_json(name))
+        return self.send(request, 404, { "error": "not found" })
+
+    def watch(self, request, names):
+        # Chunked stream of {"result": {"type": ..., "application": ...}} lines, sent when an app changes.
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+        last = {}
+        try:
+            while True:
+                for name in names:
+                    app = self.app_json(name)
+                    state = (app['status']['sync']['status'], app['status']['health']['status'], 'operation' in app, app['status']['operationState']['startedAt'])
+                    if last.get(name) != state:
+                        last[name] = state
+                        line = (json.dumps({ "result": { "type": "MODIFIED", "application": app } }) + "\n").encode()
+                        request.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                request.wfile.flush()
+                sleep(0.05)
+        except OSError:
+            return
+
+class fake_github(fake_server):
+    # Pull requests whose mergeable flag is null until mergeable_after seconds after the first fetch.
+    # Odd PRs target main and even ones release; a merge makes GitHub recompute the flag for every
+    # other open PR into the same branch. Sends ETags and answers If-None-Match with 304 like GitHub does.
+    def __init__(self, mergeable_after = 1.0, latency = 0.0):
+        self.mergeable_after = mergeable_after
+        self.first_seen = {}
+        self.merged = {}
+        super().__init__(latency)
+        return
+
+    def route(self, request, method, request_path):
+        parts = request_path.strip("/").split("/")
+        if len(parts) < 5 or parts[0] != "repos" or parts[3] != "pulls":
+            return self.send(request, 404, { "message": "Not Found" })
+        number = parts[4]
+        if method == "PUT" and parts[5:] == [ "merge" ]:
+            if self.first_seen.get(number) is None or time() - self.first_seen[number] < self.mergeable_after:
+                return self.send(request, 405, { "message": "Base branch was modified. Review and try the merge again." })
+            self.merged[number] = "2026-01-01T00:00:00Z"
+            for other in list(self.first_seen):
+                if other not in self.merged and int(other) % 2 == int(number) % 2:
+                    self.first_seen[other] = time()
+            return self.send(request, 200, { "merged": True })
+        first_seen = self.first_seen.setdefault(number, time())
+        ready = time() - first_seen >= self.mergeable_after
+        etag = f'"{number}-{ready}-{number in self.merged}"'
+        if request.headers.get("If-None-Match") == etag:
+            return self.send(request, 304, None, { "ETag": etag })
+        pr = { "number": int(number), "mergeable": (number not in self.merged) if ready else None, "merged_at": self.merged.get(number), "state": "closed" if number in self.merged else "open",
+               "base": { "ref": "main" if int(number) % 2 else "release" } }
+        return self.send(request, 200, pr, { "ETag": etag, "X-RateLimit-Remaining": "4999" })
+
+
+def run_crgen(argv, cwd, variables):
+    # Runs crgen.py and returns wall seconds, peak RSS in KB, the exit code and stderr.
+    process_env = dict(environ)
+    process_env.update(variables)
+    start = perf_counter()
+    process = subprocess.Popen([ sys.executable, crgen_path ] + argv, cwd = cwd, env = process_env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+    stderr = process.stderr.read()
+    _, status, rusage = wait4(process.pid, 0)
+    return { "wall_seconds": perf_counter() - start, "peak_rss_kb": rusage.ru_maxrss, "exit_code": status >> 8 }, stderr
+
+def files_touched(stderr):
+    # crgen prints "Parsed N files, wrote M files." at the end of imageupdate.
+    for line in stderr.splitlines():
+        if line.startswith("Parsed ") and " wrote " in line:
+            words = line.split()
+            return int(words[1]), int(words[4])
+    return None, None
+
+def git_commit(root, message):
+    # Commits everything in root, creating the repository the first time.
+    if not path.isdir(path.join(root, ".git")):
+        subprocess.run([ "git", "init", "-q" ], cwd = root, check = True)
+    subprocess.run([ "git", "add", "-A" ], cwd = root, check = True)
+    subprocess.run([ "git", "-c", "user.name=crbench", "-c", "user.email=crbench@example.com", "commit", "-q", "--no-verify", "-m", message ], cwd = root, check = True)
+    return
+
+def imageupdate_scenarios(sizes, depth, density, workers):
+    results = {}
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix = "crbench-")
+        try:
+            generate_tree(root, size, depth, density)
+            variables = { "YAML_PROPERTY": "image.tag", "ENVIRONMENT": "DEV", "SUBFOLDER_FILTER": "*", "FILENAME_FILTER": "*" }
+            # Each run sets a new tag so every matching file is rewritten, except noop which repeats the last one.
+            runs = [
+                (f"imageupdate-{size}", [ "imageupdate" ], "v2.0.0"),
+                (f"imageupdate-{size}-workers{workers}", [ "imageupdate", "--workers", str(workers) ], "v2.0.1"),
+                (f"imageupdate-{size}-index-cold", [ "imageupdate", "--index" ], "v2.0.2"),
+                (f"imageupdate-{size}-index-warm", [ "imageupdate", "--index" ], "v2.0.3"),
+                (f"imageupdate-{size}-noop", [ "imageupdate" ], "v2.0.3")
+            ]
+            for name, argv, new_value in runs:
+                variables['NEW_VALUE'] = new_value
+                result, stderr = run_crgen(argv, root, variables)
+                result['files_parsed'], result['files_written'] = files_touched(stderr)
+                result['http_requests'] = 0
+                results[name] = result
+
+            # Discovery from the git index, then from a release commit that touched a handful of manifests.
+            git_commit(root, "base")
+            git_runs = [ (f"imageupdate-{size}-git", [ "imageupdate", "--source", "git" ], "v2.0.4") ]
+            for name, argv, new_value in git_runs:
+                variables['NEW_VALUE'] = new_value
+                result, stderr = run_crgen(argv, root, variables)
+                result['files_parsed'], result['files_written'] = files_touched(stderr)
+                result['http_requests'] = 0
+                results[name] = result
+            git_commit(root, "deployed")
+            for i in range(0, min(size, 100), 10):
+                folder = next( folder for folder, _, files in walk(path.join(root, "apps")) if f"values-{i}.yaml" in files )
+                with open(path.join(folder, f"values-{i}.yaml"), "a") as f:
+                    f.write("# release\n")
+            git_commit(root, "release")
+            variables['NEW_VALUE'] = "v2.0.5"
+            result, stderr = run_crgen([ "imageupdate", "--changed-since", "HEAD~1" ], root, variables)
+            result['files_parsed'], result['files_written'] = files_touched(stderr)
+            result['http_requests'] = 0
+            results[f"imageupdate-{size}-changed-since"] = result
+        finally:
+            shutil.rmtree(root)
+    return results
+
+def deploy_scenarios(apps, sync_seconds, latency, degraded, waves):
+    results = {}
+    for stream in [ True, False ]:
+        server = fake_argocd(apps, "benchrepo", sync_seconds, [ f"app{i}" for i in range(degraded) ], latency, stream)
+        try:
+            variables = { "ARGOCD_TOKEN": "token", "ARGOCD_SERVER": server.url, "ARGOCD_APPS": "*", "ENVIRONMENT": "DEV", "REPO": "benchrepo", "ARGOCD_APP_CACHE": path.join(tempfile.gettempdir(), "crbench-apps.json") }
+            result, _ = run_crgen([ "deploy" ], tempfile.gettempdir(), variables)
+            result['files_parsed'] = result['files_written'] = 0
+            result['http_requests'] = server.requests()
+            results[f"deploy-{apps}-{'stream' if stream else 'poll'}"] = result
+        finally:
+            server.close()
+
+    # Waves from annotations with fail fast and rollback: app0 is Degraded, so only the first wave runs.
+    server = fake_argocd(apps, "benchrepo", sync_seconds, [ "app0" ], latency, True, waves)
+    try:
+        variables = { "ARGOCD_TOKEN": "token", "ARGOCD_SERVER": server.url, "ARGOCD_APPS": "*", "ENVIRONMENT": "DEV", "REPO": "benchrepo", "ARGOCD_APP_CACHE": path.join(tempfile.gettempdir(), "crbench-apps.json"),
+                      "ARGOCD_WAVE_KEY": fake_argocd.WAVE_KEY, "ARGOCD_FAIL_FAST": "true", "ARGOCD_ROLLBACK": "true" }
+        result, _ = run_crgen([ "deploy" ], tempfile.gettempdir(), variables)
+        result['files_parsed'] = result['files_written'] = 0
+        result['http_requests'] = server.requests()
+        result['rollbacks'] = len(server.rollbacks)
+        results[f"deploy-{apps}-waves{waves}-failfast"] = result
+    finally:
+        server.close()
+
+    # Same again with every app Degraded from an earlier failed sync: the new syncs fix them, so every wave runs.
+    server = fake_argocd(apps, "benchrepo", sync_seconds, [], latency, True, waves, [ f"app{i}" for i in range(apps) ])
+    try:
+        result, _ = run_crgen([ "deploy" ], tempfile.gettempdir(), dict(variables, ARGOCD_SERVER = server.url))
+        result['files_parsed'] = result['files_written'] = 0
+        result['http_requests'] = server.requests()
+        result['rollbacks'] = len(server.rollbacks)
+        results[f"deploy-{apps}-waves{waves}-failfast-recovering"] = result
+    finally:
+        server.close()
+    return results
+
+def merge_scenarios(mergeable_after, latency, queue):
+    results = {}
+    for name, argv in [ ("merge", [ "merge" ]), (f"merge-queue-{queue}", [ "merge", "--prs", ",".join( f"{n}:CHG{n:07}" for n in range(1, queue + 1) ) ]) ]:
+        server = fake_github(mergeable_after, latency)
+        try:
+            variables = { "GITHUB_API_URL": server.url, "REPO": "example/benchrepo", "PR_NUMBER": "1", "GITHUB_TOKEN": "token", "CR_NUMBER": "CHG0000001" }
+            result, _ = run_crgen(argv, tempfile.gettempdir(), variables)
+            result['files_parsed'] = result['files_written'] = 0
+            result['http_requests'] = server.requests()
+            results[name] = result
+        finally:
+            server.close()
+    return results
+
+# Metrics where bigger is worse, compared against the baseline.
+COMPARED_METRICS = [ "wall_seconds", "peak_rss_kb", "http_requests", "files_parsed", "files_written" ]
+
+def compare(results, baseline, tolerance):
+    # Prints current vs baseline per scenario and metric. Returns the regressions beyond tolerance.
+    regressions = []
+    print(f"{'scenario':<36}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = baseline[name].get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            flag = ""
+            if change > tolerance:
+                flag = " !"
+                regressions.append((name, metric))
+            print(f"{name:<36}{metric:<16}{old:>12.3f}{new:>12.3f}{change:>8.0%}{flag}")
+    return regressions
+
+def print_results(results):
+    print(f"{'scenario':<36}{'wall s':>9}{'parsed':>8}{'written':>8}{'http':>6}{'rss MB':>8}{'exit':>5}")
+    for name, result in results.items():
+        parsed = "-" if result['files_parsed'] is None else result['files_parsed']
+        written = "-" if result['files_written'] is None else result['files_written']
+        print(f"{name:<36}{result['wall_seconds']:>9.2f}{parsed:>8}{written:>8}{result['http_requests']:>6}{result['peak_rss_kb'] / 1024:>8.1f}{result['exit_code']:>5}")
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks for crgen.py.")
+    subparsers = parser.add_subparsers(dest = "benchmark", required = True)
+    subparser = subparsers.add_parser("startup", help = "Interpreter startup cost per crgen subcommand.")
+    subparser.add_argument("--runs", help = "Runs per subcommand; the median is reported.", type = int, default = 10)
+    subparser.add_argument("--json", help = "Also write the results to this file.")
+
+    subparser = subparsers.add_parser("suite", help = "End to end imageupdate, deploy and merge scenarios.")
+    subparser.add_argument("--sizes", help = "Comma separated tree sizes (files) for imageupdate.", default = "100,1000")
+    subparser.add_argument("--depth", help = "Folder nesting of the generated trees.", type = int, default = 3)
+    subparser.add_argument("--density", help = "Share of manifests that contain image.tag.", type = float, default = 0.3)
+    subparser.add_argument("--workers", help = "Worker count for the parallel imageupdate scenario.", type = int, default = 4)
+    subparser.add_argument("--apps", help = "ArgoCD applications for deploy.", type = int, default = 20)
+    subparser.add_argument("--sync-seconds", help = "How long each fake sync stays Progressing.", type = float, default = 1.0)
+    subparser.add_argument("--degraded", help = "How many apps end up Degraded after their sync.", type = int, default = 0)
+    subparser.add_argument("--waves", help = "Sync waves the fake apps are spread over for the fail fast scenario.", type = int, default = 3)
+    subparser.add_argument("--latency", help = "Added latency per fake API request, in seconds.", type = float, default = 0.02)
+    subparser.add_argument("--mergeable-after", help = "Seconds until the fake PR's mergeable flag is computed.", type = float, default = 1.0)
+    subparser.add_argument("--queue", help = "PRs in the merge queue scenario.", type = int, default = 6)
+    subparser.add_argument("--only", help = "Comma separated subset of imageupdate,deploy,merge.", default = "imageupdate,deploy,merge")
+    subparser.add_argument("--json", help = "Write the results to this file.")
+    subparser.add_argument("--baseline", help = "Compare against results saved earlier with --json.")
+    subparser.add_argument("--tolerance", help = "Allowed growth over the baseline before a metric counts as a regression.", type = float, default = 0.10)
+    options = parser.parse_args()
+
+    if options.benchmark == "startup":
+        results = startup_benchmark(options.runs)
+        print_startup(results)
+        if options.json:
+            with open(options.json, "w") as f:
+                json.dump({ "startup": results }, f, indent = 2)
+
+    elif options.benchmark == "suite":
+        only = [ part.strip() for part in options.only.split(",") ]
+        results = {}
+        if "imageupdate" in only:
+            results.update(imageupdate_scenarios([ int(size) for size in options.sizes.split(",") ], options.depth, options.density, options.workers))
+        if "deploy" in only:
+            results.update(deploy_scenarios(options.apps, options.sync_seconds, options.latency, options.degraded, options.waves))
+        if "merge" in only:
+            results.update(merge_scenarios(options.mergeable_after, options.latency, options.queue))
+        print_results(results)
+
+        if options.json:
+            with open(options.json, "w") as f:
+                json.dump({
+                    "meta": { "created": strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(), "options": vars(options) },
+                    "results": results
+                }, f, indent = 2)
+
+        if options.baseline:
+            with open(options.baseline) as f:
+                baseline = json.load(f)['results']
+            print("")
+            regressions = compare(results, baseline, options.tolerance)
+            if len(regressions) > 0:
+                print(f"\n{len(regressions)} metrics regressed more than {options.tolerance:.0%}.")
+                sys.exit(1)
@@ -1,73 +1,443 @@
 import json
-import ruamel.yaml
 from os import environ as env
-from os import path, walk, sep
-from time import strftime, localtime, time, sleep
+from os import path, walk, sep, stat, replace, chmod, remove
+from time import strftime, localtime, time, sleep, perf_counter
 import argparse
-import requests
 import re, sys
+import random
+from threading import Lock, Condition, local, current_thread, get_ident
+from fnmatch import fnmatch
+from io import StringIO
+from contextlib import redirect_stdout
+from os import cpu_count, getpid
+from hashlib import sha256
+from difflib import unified_diff
+from string import Formatter
+
+# ruamel.yaml, requests and concurrent.futures are imported where they're first needed,
+# so each subcommand only pays for what it uses. See COMMAND_IMPORTS and crbench.py.
+
+# Options the classes read. main() replaces these with the parsed command line.
+args = argparse.Namespace(verbose = False, simple = False, workers = int(env.get('WORKERS', 1)), index = False, dry_run = False, changed_files = None,
+    source = env.get('CRGEN_FILE_SOURCE', 'walk'), changed_since = env.get('CHANGED_SINCE') or None)
+
+def set_args(options):
+    # Also the process pool initializer, so workers see the same options however they were started.
+    global args, _worker_updater
+    args = options
+    _worker_updater = None
+    return
+
+_round_trip_yaml = None
+
+def round_trip_yaml():
+    global _round_trip_yaml
+    if _round_trip_yaml is None:
+        import ruamel.yaml
+        _round_trip_yaml = ruamel.yaml.YAML()
+    return _round_trip_yaml
+
+class trace_span:
+    # One timed phase. Attributes can be added while it runs with set().
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        return
 
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--cr_json", help="Generate Initial CR JSON", action="store_true")
-parser.add_argument("--cr_update", help="Generate CR JSON for Update (with callback URL and PR/CR number)", action="store_true")
-parser.add_argument("--deploy", help="ArgoCD Sync. Monitor Sync Status.", action="store_true")
-parser.add_argument("--imageupdate", help="Update image tags for deployment.", action="store_true")
-parser.add_argument("--verbose", help="More/wordier output.", action="store_true")
-parser.add_argument("--simple", help="Omit custom fields and stuff when creating the CR.", action="store_true")
-parser.add_argument("--secretname", help="Just spit out name of argocd server.", action="store_true")
-parser.add_argument("--merge", help="Merge currently active Pull Request", action="store_true")
-args = parser.parse_args()
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.id = self.tracer.next_id()
+        self.parent = stack[-1] if len(stack) > 0 else None
+        stack.append(self.id)
+        self.start = time()
+        self.clock = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = perf_counter() - self.clock
+        self.tracer.stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.start, duration, self.attrs, self.id, self.parent)
+        return False
+
+class null_span:
+    # What span() hands out while tracing is off: no clock reads and nothing recorded.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        return
+
+class span_tracer:
+    # Spans for the hot paths (walk, yaml parse/dump, http calls, monitor cycles), exported when the run ends:
+    #   CRGEN_TRACE=file            append every span to file as JSON Lines
+    #   CRGEN_TRACE_PROM=file       write per phase totals as a Prometheus textfile (node_exporter textfile collector)
+    #   CRGEN_TRACE_SUMMARY=true    append a timing table to $GITHUB_STEP_SUMMARY
+    #   CRGEN_PROFILE=file          run the subcommand under cProfile and dump the stats to file
+    # With none of the first three set, span() returns a shared null_span and costs one attribute check.
+    NULL_SPAN = null_span()
+
+    def __init__(self):
+        self.jsonl_path = env.get('CRGEN_TRACE')
+        self.prometheus_path = env.get('CRGEN_TRACE_PROM')
+        self.summary_path = env.get('GITHUB_STEP_SUMMARY') if env.get('CRGEN_TRACE_SUMMARY', '').lower() in [ "1", "true", "yes" ] else None
+        self.enabled = bool(self.jsonl_path or self.prometheus_path or self.summary_path)
+        self.spans = []
+        self.ids = 0
+        self.lock = Lock()
+        self.local = local()
+        return
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return self.NULL_SPAN
+        return trace_span(self, name, attrs)
+
+    def stack(self):
+        # Open span ids on this thread, so nested spans know their parent.
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def next_id(self):
+        with self.lock:
+            self.ids += 1
+            return f"{getpid()}-{self.ids}"
+
+    def record(self, name, start, duration, attrs, span_id = None, parent = None):
+        # Also used directly for phases that aren't a single block of code, like the directory walk.
+        if not self.enabled:
+            return
+        entry = { "name": name, "start": start, "duration_ms": round(duration * 1000, 3), "id": span_id or self.next_id(), "parent": parent, "pid": getpid(), "thread": current_thread().name }
+        entry.update(attrs)
+        with self.lock:
+            self.spans.append(entry)
+        return
+
+    def mark(self):
+        return len(self.spans)
+
+    def take(self, mark):
+        # Spans recorded since mark, removed so a pool worker can hand them back to the parent process.
+        with self.lock:
+            taken = self.spans[mark:]
+            del self.spans[mark:]
+        return taken
+
+    def extend(self, spans):
+        with self.lock:
+            self.spans.extend(spans)
+        return
+
+    def aggregate(self):
+        # (phase, endpoint) -> count, total/max seconds and errors. http spans are split per endpoint.
+        phases = {}
+        for entry in self.spans:
+            key = (entry['name'], entry.get('endpoint', ""))
+            phase = phases.setdefault(key, { "count": 0, "seconds": 0.0, "max": 0.0, "errors": 0 })
+            seconds = entry['duration_ms'] / 1000
+            phase['count'] += 1
+            phase['seconds'] += seconds
+            phase['max'] = max(phase['max'], seconds)
+            if 'error' in entry or entry.get('status', 0) > 399:
+                phase['errors'] += 1
+        return phases
+
+    def export(self, command):
+        if not self.enabled:
+            return
+        phases = self.aggregate()
+        try:
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a') as f:
+                    for entry in self.spans:
+                        f.write(json.dumps(entry) + "\n")
+            if self.prometheus_path:
+                self.write_prometheus(phases, command)
+            if self.summary_path:
+                self.write_summary(phases, command)
+        except OSError as e:
+            print(f"Unable to export trace: {e}", file=sys.stderr)
+        return
+
+    def write_prometheus(self, phases, command):
+        def labels(name, endpoint):
+            escaped = [ (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in [ ("command", command), ("phase", name), ("endpoint", endpoint) ] if v ]
+            return "{" + ",".join( f'{k}="{v}"' for k, v in escaped ) + "}"
+
+        lines = []
+        for metric, kind, field, description in [
+            ( "crgen_phase_seconds_total", "counter", "seconds", "Time spent in each traced phase." ),
+            ( "crgen_phase_count_total", "counter", "count", "Times each traced phase ran." ),
+            ( "crgen_phase_seconds_max", "gauge", "max", "Longest single run of each traced phase." ),
+            ( "crgen_phase_errors_total", "counter", "errors", "Traced phases that raised or got an HTTP error status." )
+        ]:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (name, endpoint), phase in sorted(phases.items()):
+                lines.append(f"{metric}{labels(name, endpoint)} {round(phase[field], 6)}")
+        lines.append("# HELP crgen_last_run_timestamp_seconds When this textfile was written.")
+        lines.append("# TYPE crgen_last_run_timestamp_seconds gauge")
+        lines.append(f'crgen_last_run_timestamp_seconds{{command="{command}"}} {time():.0f}')
+
+        # The textfile collector may read at any moment, so never let it see a partial file.
+        atomic_write(self.prometheus_path, "\n".join(lines) + "\n")
+        return
+
+    def write_summary(self, phases, command):
+        lines = [ f"### crgen {command} timings", "", "| Phase | Endpoint | Count | Total s | Mean ms | Max ms | Errors |", "| --- | --- | ---: | ---: | ---: | ---: | ---: |" ]
+        for (name, endpoint), phase in sorted(phases.items(), key = lambda item: -item[1]['seconds']):
+            lines.append(f"| {name} | {endpoint.replace('|', '&#124;')} | {phase['count']} | {phase['seconds']:.2f} | {phase['seconds'] / phase['count'] * 1000:.1f} | {phase['max'] * 1000:.1f} | {phase['errors']} |")
+        with open(self.summary_path, 'a') as f:
+            f.write("\n".join(lines) + "\n\n")
+        return
+
+tracer = span_tracer()
+
+class http_response:
+    # The parts of a requests.Response we use, with the body decoded at most once.
+    def __init__(self, r):
+        self.status_code = r.status_code
+        self.headers = r.headers
+        self.text = r.text
+        self._json = None
+        self._decoded = False
+        return
+
+    def json(self):
+        if not self._decoded:
+            self._json = json.loads(self.text)
+            self._decoded = True
+        return self._json
+
+class http_client:
+    # One keep-alive session shared by everything that talks to ArgoCD or GitHub.
+    # Adds timeouts, jittered retries on 429/5xx, and per endpoint request counts and latency.
+    RETRY_STATUS = [ 429, 500, 502, 503, 504 ]
+    # A POST/PUT/DELETE that got one of these was not acted on, so it's safe to send again.
+    RETRY_STATUS_POST = [ 429, 503 ]
 
-class pr_merger:
     def __init__(self):
-        self.pr_number = env['PR_NUMBER']
-        self.pr_url = f"https://api.github.com/repos/{env['REPO']}/pulls/{self.pr_number}"
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.exceptions import InsecureRequestWarning
+        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        # Callers catch these without importing requests themselves.
+        self.request_error = requests.RequestException
+        self.retry_error = (requests.ConnectionError, requests.Timeout)
+        self.connect_timeout = requests.exceptions.ConnectTimeout
+        from urllib3.exceptions import NewConnectionError
+        self.new_connection_error = NewConnectionError
+
+        self.timeout = ( float(env.get('HTTP_CONNECT_TIMEOUT', 10)), float(env.get('HTTP_READ_TIMEOUT', 60)) )
+        self.retries = int(env.get('HTTP_RETRIES', 3))
+        self.backoff = float(env.get('HTTP_BACKOFF', 1))
+        pool_size = int(env.get('HTTP_POOL_SIZE', 16))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.stats = {}
+        self.lock = Lock()
+        return
+
+    def record(self, endpoint, elapsed, retried):
+        with self.lock:
+            entry = self.stats.setdefault(endpoint, { "requests": 0, "retries": 0, "seconds": 0.0 })
+            entry['requests'] += 1
+            entry['retries'] += retried
+            entry['seconds'] += elapsed
+        return
+
+    def never_sent(self, e):
+        # True when the connection was never established, so the server can't have seen the request.
+        # A read timeout or a dropped connection may come after the server already acted on it.
+        if isinstance(e, self.connect_timeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None
+        return isinstance(reason, self.new_connection_error)
+
+    def retry_delay(self, attempt, r):
+        # Honour Retry-After when the server sends one, otherwise exponential backoff with full jitter.
+        if r is not None and r.headers.get('Retry-After', '').isdigit():
+            return int(r.headers['Retry-After'])
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def request(self, method, url, endpoint = None, stream = False, **kwargs):
+        # endpoint is the label stats are kept under, e.g. "GET /api/v1/applications/{app}".
+        endpoint = endpoint or f"{method} {url}"
+        kwargs.setdefault('timeout', self.timeout)
+        # Only GETs are safe to repeat whatever happened; anything else is retried only when it wasn't acted on.
+        idempotent = method == "GET"
+        retry_status = self.RETRY_STATUS if idempotent else self.RETRY_STATUS_POST
+        start = time()
+        attempt = 0
+        with tracer.span("http", endpoint = endpoint) as trace:
+            while True:
+                r = None
+                try:
+                    r = self.session.request(method, url, stream = stream, **kwargs)
+                    if r.status_code not in retry_status or attempt >= self.retries:
+                        break
+                except self.retry_error as e:
+                    if attempt >= self.retries or not (idempotent or self.never_sent(e)):
+                        self.record(endpoint, time() - start, attempt)
+                        trace.set(retries = attempt)
+                        raise
+                delay = self.retry_delay(attempt, r)
+                if r is not None:
+                    r.close()
+                print(f"Retrying {endpoint} in {delay:.1f}s.", file=sys.stderr)
+                sleep(delay)
+                attempt += 1
+            trace.set(status = r.status_code, retries = attempt)
+
+        self.record(endpoint, time() - start, attempt)
+        # Streams are handed back as is for the caller to iterate.
+        return r if stream else http_response(r)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def print_stats(self):
+        if len(self.stats) == 0:
+            return
+        print("HTTP requests:", file=sys.stderr)
+        for endpoint in sorted(self.stats.keys()):
+            entry = self.stats[endpoint]
+            print(f"  {endpoint}: {entry['requests']} requests, {entry['retries']} retries, {entry['seconds']:.2f}s", file=sys.stderr)
+        return
+
+_http_client = None
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = http_client()
+    return _http_client
+
+class pr_merger:
+    def __init__(self, pr_number = None, cr_number = None, label = None):
+        # pr_number/cr_number default to PR_NUMBER/CR_NUMBER; merge_queue passes one PR each.
+        # label tags log lines, so output from PRs checked at the same time can be told apart.
+        self.label = label
+        self.pr_number = str(pr_number or env['PR_NUMBER'])
+        self.cr_number = cr_number or env['CR_NUMBER']
+        # GITHUB_API_URL is set by Actions, and differs on GitHub Enterprise Server.
+        self.pr_url = f"{env.get('GITHUB_API_URL', 'https://api.github.com')}/repos/{env['REPO']}/pulls/{self.pr_number}"
         self.merge_url = f"{self.pr_url}/merge"
         self.github_headers = {
             "Accept": "application/vnd.github+json",
             "X-GitHub-Api-Version": "2022-11-28",
             "Authorization": f"Bearer {env['GITHUB_TOKEN']}"
         }
+        self.http = get_http_client()
         self.merge_data = {
             "commit_title": "ArgoCD Deploy",
-            "commit_message": f"Merge Deploy PR for CR {env['CR_NUMBER']}"
+            "commit_message": f"Merge Deploy PR for CR {self.cr_number}"
         }
+        # Outcome of the last check_mergeability/merge, for merge_queue's summary.
+        self.status = None
+        self.pr = None
+        self.merge_code = None
         return
 
-    def check_mergeability(self):
+    def log(self, *message):
+        if self.label is None:
+            print(*message, file=sys.stderr)
+        else:
+            print(f"[{self.label}]", *message, file=sys.stderr)
+        return
+
+    def rate_limit_wait(self, r):
+        # Seconds GitHub asked us to wait, via Retry-After or an exhausted X-RateLimit-Remaining, else None.
+        if r.headers.get('Retry-After', '').isdigit():
+            return int(r.headers['Retry-After'])
+        if r.headers.get('X-RateLimit-Remaining') == "0" and r.headers.get('X-RateLimit-Reset', '').isdigit():
+            return max(0, int(r.headers['X-RateLimit-Reset']) - int(time()))
+        return None
+
+    def fetch_pr(self):
         # There's a "mergeable" attribute for a PR that is lazily populated when you fetch the PR and then fetch it again a little bit later.
-        r = requests.get( self.pr_url, headers = self.github_headers )
-        print("Waiting five seconds for mergeability calculation.", file=sys.stderr)
-        sleep(5)
-        r = requests.get( self.pr_url, headers = self.github_headers )
-        pr = r.json()
+        # Poll quickly at first and back off until it's known or the deadline passes. Polls are conditional,
+        # so an unchanged PR comes back as a 304 that doesn't count against the rate limit.
+        deadline = time() + float(env.get('MERGEABLE_TIMEOUT', 60))
+        interval = float(env.get('MERGEABLE_POLL_MIN', 0.5))
+        max_interval = float(env.get('MERGEABLE_POLL_MAX', 8))
+        headers = dict(self.github_headers)
+        pr = None
+        while True:
+            r = self.http.get( self.pr_url, headers = headers, endpoint = "GET /pulls/{pr}" )
+            wait = self.rate_limit_wait(r)
+            if r.status_code == 304:
+                pass
+            elif r.status_code > 299:
+                if wait is None or r.status_code not in [ 403, 429 ]:
+                    return r, None
+            else:
+                pr = r.json()
+                if r.headers.get('ETag'):
+                    headers['If-None-Match'] = r.headers['ETag']
+                if pr['mergeable'] is not None or pr['merged_at'] is not None or pr.get('state') == "closed":
+                    return r, pr
+
+            wait = interval if wait is None else max(wait, interval)
+            if time() + wait > deadline:
+                return r, pr
+            self.log(f"Waiting {wait:.1f}s for mergeability calculation.")
+            sleep(wait)
+            interval = min(interval * 2, max_interval)
+
+    def check_mergeability(self):
+        r, pr = self.fetch_pr()
+        if pr is not None:
+            self.pr = pr
 
         isError = False
-        if r.status_code > 299:
+        if pr is None:
             print("Unable to query PR status.", r.text)
+            self.status = "unknown"
             isError = True
         elif pr['mergeable'] in [ False, None ]:
             print("Pull request", self.pr_number, "is not in a mergeable state.")
+            self.status = "not_mergeable"
             isError = True
         elif pr['merged_at'] is not None:
             print("Pull request", self.pr_number, "was already merged.")
+            self.status = "already_merged"
             isError = True
         else:
-            print("PR is mergeable.", file=sys.stderr)
+            self.log("PR is mergeable.")
+            self.status = "mergeable"
 
         return isError
 
     def merge(self):
         isError = False
-        r = requests.put( self.merge_url, headers = self.github_headers, data = json.dumps(self.merge_data) )
+        r = self.http.put( self.merge_url, headers = self.github_headers, data = json.dumps(self.merge_data), endpoint = "PUT /pulls/{pr}/merge" )
+        self.merge_code = r.status_code
         if r.status_code > 299:
-            print(r.text, file=sys.stderr)
+            self.log(r.text)
+            self.status = "merge_failed"
             isError = True
         else:
             print("Merge successful")
+            self.status = "merged"
             isError = False
         return isError
 
@@ -79,14 +449,128 @@ class pr_merger:
             isError = self.merge()
         return isError
 
+def merge_queue_entries(prs, prs_file):
+    # [(pr, cr)] from "12,13:CHG0001234" and/or a JSON file holding a list of PR numbers and
+    # {"pr": 13, "cr": "CHG0001234"} objects, or a {"12": "CHG0001234"} mapping. CR_NUMBER fills in missing CRs.
+    entries = []
+    if prs:
+        for item in prs.split(','):
+            if item.strip():
+                pr, _, cr = item.strip().partition(':')
+                entries.append((pr.strip(), cr.strip() or None))
+    if prs_file:
+        with open(prs_file) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [ { "pr": pr, "cr": cr } for pr, cr in data.items() ]
+        for item in data:
+            if isinstance(item, dict):
+                entries.append((str(item['pr']), item.get('cr')))
+            else:
+                entries.append((str(item), None))
+
+    queue, seen = [], set()
+    for pr, cr in entries:
+        if not pr.lstrip('#').isdigit():
+            raise Exception(f"Invalid PR number {pr}")
+        pr = pr.lstrip('#')
+        if pr in seen:
+            continue
+        seen.add(pr)
+        cr = cr or env.get('CR_NUMBER')
+        if not cr:
+            raise Exception(f"No CR number for PR {pr}: give it as {pr}:<CR> or set CR_NUMBER.")
+        queue.append((pr, cr))
+    return queue
+
+class merge_queue:
+    # Merges several PRs in one run with the same check_mergeability/merge as a single PR. Every PR is
+    # checked concurrently, then merged in the given order. PRs into the same base branch merge one after
+    # another, because each merge changes the others' mergeability, and the ones behind a merge are
+    # checked again first. Different base branches go in parallel, MERGE_CONCURRENCY at a time.
+    def __init__(self, entries, concurrency):
+        self.mergers = [ pr_merger(pr, cr, label = f"#{pr}") for pr, cr in entries ]
+        self.concurrency = max(1, concurrency)
+        return
+
+    def check(self, merger):
+        # A PR GitHub can't be reached for gets an "error" result; the rest of the queue carries on.
+        try:
+            merger.check_mergeability()
+        except merger.http.request_error as e:
+            merger.log(f"Unable to query PR status: {e}")
+            merger.status = "error"
+        return merger
+
+    def merge_branch(self, mergers):
+        merged = False
+        for merger in mergers:
+            try:
+                if merged and merger.status not in [ "already_merged", "unknown" ]:
+                    merger.log("Re-checking after an earlier merge.")
+                    merger.check_mergeability()
+                if merger.status != "mergeable":
+                    continue
+                # 405/409 here usually means GitHub hadn't caught up with the earlier merge yet: check again and retry once.
+                if merger.merge() and merger.merge_code in [ 405, 409 ] and not merger.check_mergeability():
+                    merger.merge()
+            except merger.http.request_error as e:
+                merger.log(f"Request failed: {e}")
+                merger.status = "error"
+            merged = merged or merger.status == "merged"
+        return
+
+    def execute(self, results_path = None):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = self.concurrency) as pool:
+            list(pool.map(with_request_output(self.check), self.mergers))
+
+            branches = {}
+            for merger in self.mergers:
+                base = (merger.pr or {}).get('base', {}).get('ref')
+                branches.setdefault(base, []).append(merger)
+            list(pool.map(with_request_output(self.merge_branch), branches.values()))
+
+        isError = False
+        results = []
+        print("", file=sys.stderr)
+        print("Merge queue summary:", file=sys.stderr)
+        for merger in self.mergers:
+            base = (merger.pr or {}).get('base', {}).get('ref')
+            results.append({ "pr": int(merger.pr_number), "cr": merger.cr_number, "base": base, "status": merger.status or "unknown" })
+            if merger.status != "merged":
+                isError = True
+            print(f"  #{merger.pr_number} {merger.cr_number} into {base or '?'}: {(merger.status or 'unknown').replace('_', ' ')}", file=sys.stderr)
+
+        if results_path:
+            with open(results_path, 'w') as f:
+                for result in results:
+                    f.write(json.dumps(result) + "\n")
+        return isError
+
 class deployment_updater:
     REQ_VAR = [ "YAML_PROPERTY", "NEW_VALUE", "ENVIRONMENT", "SUBFOLDER_FILTER", "FILENAME_FILTER" ]
-    yaml = ruamel.yaml.YAML()
+    # Directories never descended into. More can be added with a comma separated IGNORE_DIRS.
+    IGNORE_DIRS = [ ".git", "node_modules", ".terraform", "__pycache__" ]
 
     def __init__(self):
         for v in self.REQ_VAR:
             if v not in env.keys():
                 raise Exception(f"Missing environment variable {v}")
+        self.yaml = round_trip_yaml()
+        self.update_properties = [ prop.strip() for prop in env['YAML_PROPERTY'].split(',') if prop.strip() ]
+        self.paths = [ compile_property_path(prop) for prop in self.update_properties ]
+        # Cheap text check before a yaml parse: the file has to mention at least one leaf key.
+        # Paths made only of wildcards and indexes have no key to look for, so every file gets parsed.
+        self.leaf_keys = [ p.leaf_key.encode() for p in self.paths ] if all( p.leaf_key for p in self.paths ) else None
+        self.ignore_dirs = ignore_dirs(self.IGNORE_DIRS)
+        # Every candidate file is parsed at most once and written at most once; these count both.
+        self.stats = { "parsed": 0, "written": 0, "indexed": 0, "unchanged": 0 }
+        self.index = open_property_index(index_path()) if args.index or "CRGEN_INDEX" in env.keys() else None
+        self.loaded = None
+        self.loaded_text = None
+        # NEW_VALUE as the emitter would write it, for patching scalars in place.
+        self.rendered = {}
         return
 
     def update_deployments(self):
@@ -95,107 +579,753 @@ class deployment_updater:
                 print(f"{variable_name}: {env[variable_name]}")
             print("")
 
-            for file in self.find_files():
-                print("Updating", file)
-                self.update_property(file)
+        files = self.find_files()
+        if self.index is not None:
+            files = self.index.filter(files, self.paths, self.stats)
+
+        isError = False
+        changed = []
+        for file, updated, output, error, stats, entry, spans in self.update_files(files):
+            print(output, end='')
+            tracer.extend(spans)
+            if len(updated) > 0:
+                changed.append(file)
+            if entry is not None:
+                self.index.record(file, entry)
+            for k in stats.keys():
+                self.stats[k] += stats[k]
+            if error is not None:
+                print(f"Error updating {file}: {error}", file=sys.stderr)
+                isError = True
+            elif args.verbose and updated and not args.dry_run:
                 print("Update complete for", file)
                 print("File Contents:")
                 print(open(file,'r').read())
                 print("")
+
+        if self.index is not None and not args.dry_run:
+            self.index.save()
+        self.print_stats()
+        self.print_changed(changed)
+        return isError
+
+    def update_files(self, files):
+        # Results always come back in the same order as files, so serial and parallel output match.
+        global _worker_updater
+        workers = args.workers if args.workers > 0 else cpu_count()
+        if workers == 1:
+            # A fresh updater per run, so a long lived process (serve) never reuses another run's settings.
+            _worker_updater = None
+            yield from map(update_file_worker, files)
             return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers = workers, initializer = set_args, initargs = (args,)) as pool:
+            yield from pool.map(update_file_worker, files, chunksize = 16)
+
+    def print_stats(self):
+        print(f"Parsed {self.stats['parsed']} files, {'would write' if args.dry_run else 'wrote'} {self.stats['written']} files.", file=sys.stderr)
+        if self.stats['unchanged'] > 0:
+            print(f"Left {self.stats['unchanged']} files alone, they already had NEW_VALUE.", file=sys.stderr)
+        if self.index is not None:
+            print(f"Skipped {self.stats['indexed']} unchanged files using the index.", file=sys.stderr)
+        return
 
-        else:
-            for file in self.find_files():
-                self.update_property(file)
+    def print_changed(self, changed):
+        # The list is also written to --changed-files, one path per line, e.g. for a later git add.
+        if len(changed) > 0:
+            print("Changed files:" if not args.dry_run else "Files that would change:", file=sys.stderr)
+            for file in changed:
+                print(" ", file, file=sys.stderr)
+        if args.changed_files:
+            with open(args.changed_files, 'w') as f:
+                f.write("".join( file + "\n" for file in changed ))
         return
 
     def find_all_files(self):
-        file_paths = []
-        for root, _, files in walk('.'):
-            for file in files:
-                file_paths.append(path.join(root, file))
-        return file_paths
-
-    def set_property(self, proplist, the_dict, newvalue):
-        if len(proplist) == 1:
-            if proplist[0] in the_dict.keys():
-                the_dict[proplist[0]] = newvalue
-                return True
-            else:
-                return False
-        else:
-            return self.set_property(proplist[1:], the_dict[proplist[0]], newvalue)
+        # The working tree by default. The git sources only ever see tracked files, and --changed-since
+        # only the ones changed between that ref and HEAD.
+        if args.changed_since:
+            return git_changed_files(args.changed_since, self.ignore_dirs)
+        if args.source == "git":
+            return git_tracked_files(self.ignore_dirs)
+        return walk_files(self.ignore_dirs)
+
+    def load_yaml(self, file):
+        # Returns the file's documents, or None for anything that isn't parseable yaml or can't contain any of the properties.
+        try:
+            with open(file, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # With the index on, every file is parsed once so its property paths can be recorded.
+        if self.index is None and self.leaf_keys is not None and not any( key in data for key in self.leaf_keys ):
+            return None
 
-    def follow_properties(self, proplist, the_dict):
-        if len(proplist) == 1:
-            try:
-                if proplist[0] in the_dict.keys():
-                    return True
+        self.stats['parsed'] += 1
+        try:
+            self.loaded_text = data.decode()
+            with tracer.span("yaml.parse", file = file, bytes = len(data)):
+                return list(self.yaml.load_all(self.loaded_text))
+        except Exception:
+            return None
+
+    def update_property(self, file):
+        # Parse once, match every requested path in one pass over all of the file's documents, write once.
+        # Returns the list of properties that were updated.
+        documents = self.loaded = self.load_yaml(file)
+        if documents is None:
+            return []
+
+        matches = match_property_paths(documents, self.paths)
+        if not any(matches):
+            return []
+
+        if args.verbose:
+            print("Updating", file)
+
+        # Matches that already hold NEW_VALUE are left alone, and a file with nothing to change isn't written.
+        new_value = env['NEW_VALUE']
+        updated, targets, seen = [], [], set()
+        for propertystring, found in zip(self.update_properties, matches):
+            if len(found) == 0:
+                print("File", file, "does not contain property", propertystring)
+                continue
+            changing = False
+            for document, parent, key, location in found:
+                if args.verbose:
+                    print(f"  {location} in document {document + 1}, line {match_line(parent, key)}")
+                if isinstance(parent[key], str) and parent[key] == new_value:
+                    continue
+                changing = True
+                # Two paths can match the same scalar, e.g. image.tag and image.*
+                if (id(parent), key) not in seen:
+                    seen.add((id(parent), key))
+                    targets.append((parent, key))
+            if changing:
+                updated.append(propertystring)
+
+        if len(updated) == 0:
+            self.stats['unchanged'] += 1
+            return []
+
+        # Patch just the scalars' characters when every one of them can be, otherwise re-emit the whole document.
+        text = self.loaded_text
+        new_text = self.patch_scalars(text, targets, new_value)
+        if new_text is None:
+            for parent, key in targets:
+                parent[key] = new_value
+            output = StringIO()
+            with tracer.span("yaml.dump", file = file):
+                if len(documents) == 1:
+                    self.yaml.dump(documents[0], output)
                 else:
-                    return False
-            except:
-                return False
+                    self.yaml.dump_all(documents, output)
+            new_text = output.getvalue()
 
-        try:
-            if proplist[0] in the_dict.keys():
-                return self.follow_properties(proplist[1:], the_dict[proplist[0]])
+        if args.dry_run:
+            print("".join(unified_diff(text.splitlines(True), new_text.splitlines(True), f"a/{path.normpath(file)}", f"b/{path.normpath(file)}")), end='')
+        else:
+            atomic_write(file, new_text)
+        self.stats['written'] += 1
+        return updated
+
+    def render_scalar(self, value):
+        # How a block mapping value of this string comes out of the emitter, or None if it takes more than one line.
+        if value not in self.rendered:
+            output = StringIO()
+            self.yaml.dump({ "k": value }, output)
+            rendered = output.getvalue()[len("k: "):-1]
+            self.rendered[value] = rendered if "\n" not in rendered else None
+        return self.rendered[value]
+
+    def patch_scalars(self, text, targets, new_value):
+        # New text with each (container, key) scalar replaced by new_value, or None if any of them can't be patched in place.
+        rendered = self.render_scalar(new_value)
+        if rendered is None or text.startswith("\ufeff"):
+            return None
+        line_starts = [ 0 ] + [ m.end() for m in re.finditer("\n", text) ]
+        spans = []
+        for parent, key in targets:
+            span = scalar_span(text, line_starts, parent, key)
+            if span is None:
+                return None
+            spans.append(span)
+        for start, end in sorted(spans, reverse = True):
+            text = text[:start] + rendered + text[end:]
+        return text
+
+    def filename_matches(self, file):
+        # FILENAME_FILTER with glob characters is matched against the file name, otherwise it's a substring of the path.
+        filename_filter = env['FILENAME_FILTER'].lower()
+        if filename_filter == "*":
+            return True
+        if any( c in filename_filter for c in "*?[" ):
+            return fnmatch(path.basename(file).lower(), filename_filter)
+        return filename_filter in file.lower()
+
+    def find_files(self):
+        # Candidate files only, generated lazily; whether a file actually contains
+        # YAML_PROPERTY is decided by update_property so each file is only parsed once.
+        subfolder_filter = env['SUBFOLDER_FILTER'].lower()
+        for file in self.find_all_files():
+            lowered = file.lower()
+
+            # filter yaml files only
+            if not (lowered.endswith(".yml") or lowered.endswith(".yaml")):
+                continue
+
+            # optionally filter on FILENAME_FILTER
+            if not self.filename_matches(file):
+                continue
+
+            # optionally filter on SUBFOLDER_FILTER
+            if subfolder_filter != "*" and subfolder_filter not in lowered:
+                continue
+
+            yield file
+
+
+def path_label(location, key):
+    # How match locations and index entries spell a step: name, [index], or ['name'] when it has . or [ in it.
+    if isinstance(key, int) and not isinstance(key, bool):
+        return f"{location}[{key}]"
+    key = str(key)
+    if any( c in key for c in ".[]" ):
+        return f"{location}['{key}']"
+    return f"{location}.{key}" if location else key
+
+def match_line(parent, key):
+    # 1-based line of a matched value, from the round-trip loader's position info.
+    try:
+        return (parent.lc.item(key) if isinstance(parent, list) else parent.lc.value(key))[0] + 1
+    except (AttributeError, KeyError, IndexError, TypeError):
+        return "?"
+
+compiled_property_paths = {}
+
+def compile_property_path(expression):
+    # Compiled once per process; serve reuses them across requests.
+    if expression not in compiled_property_paths:
+        compiled_property_paths[expression] = property_path(expression)
+    return compiled_property_paths[expression]
+
+class property_path:
+    # A YAML_PROPERTY expression: dotted keys, * for every key of a mapping, [n] for a list index
+    # (negative counts from the end), [*] for every list item, [field=value] for the list items whose
+    # field is value, and ['some.key'] for keys with dots in them.
+    #   image.tag
+    #   spec.template.spec.containers[*].image
+    #   spec.template.spec.containers[name=api].image
+    #   metadata.labels['app.kubernetes.io/version']
+    TOKEN = re.compile(r"""(\.)?([^.\[\]]+)|\[(-?\d+|\*|'[^']*'|"[^"]*"|[^=\]]+=[^\]]*)\]""")
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.steps = []
+        position = 0
+        while position < len(expression):
+            m = self.TOKEN.match(expression, position)
+            # Keys after the first need their dot, and a dot has to be followed by a key.
+            if m is None or (m.group(2) is not None and (m.group(1) is None) != (position == 0)):
+                raise Exception(f"Invalid property path {expression}: unexpected {expression[position:]!r}")
+            position = m.end()
+            if m.group(2) is not None:
+                self.steps.append(("any_key",) if m.group(2) == "*" else ("key", m.group(2)))
+                continue
+            selector = m.group(3)
+            if selector == "*":
+                self.steps.append(("all",))
+            elif selector[0] in "'\"":
+                self.steps.append(("key", selector[1:-1]))
+            elif "=" in selector:
+                field, value = selector.split("=", 1)
+                self.steps.append(("select", field.strip(), value.strip().strip("'\"")))
             else:
-                return False
-        except:
+                self.steps.append(("index", int(selector)))
+        if len(self.steps) == 0:
+            raise Exception(f"Invalid property path {expression!r}")
+        literal = [ step[1] for step in self.steps if step[0] == "key" ]
+        self.leaf_key = literal[-1] if len(literal) > 0 else None
+        self.index_pattern = re.compile(self.index_regex())
+        return
+
+    def step_matches(self, position, node, key, child):
+        step = self.steps[position]
+        kind = step[0]
+        if kind == "key":
+            return isinstance(node, dict) and key == step[1]
+        if kind == "any_key":
+            return isinstance(node, dict)
+        if not isinstance(node, list):
             return False
+        if kind == "all":
+            return True
+        if kind == "index":
+            return key == (step[1] if step[1] >= 0 else len(node) + step[1])
+        return isinstance(child, dict) and step[1] in child and str(child[step[1]]) == step[2]
+
+    def index_regex(self):
+        # Matches the property_index paths this expression could match. Selectors and negative indexes
+        # depend on values the index doesn't keep, so they match any list item.
+        parts = []
+        for step in self.steps:
+            if step[0] == "key":
+                label = path_label("", step[1])
+                parts.append(re.escape(label) if label.startswith("[") or len(parts) == 0 else re.escape("." + label))
+            elif step[0] == "any_key":
+                parts.append(("" if len(parts) == 0 else r"\.") + r"[^.\[\]]+|\['[^']*'\]")
+                parts[-1] = f"(?:{parts[-1]})"
+            elif step[0] == "index" and step[1] >= 0:
+                parts.append(re.escape(f"[{step[1]}]"))
+            else:
+                parts.append(r"\[\d+\]")
+        return "".join(parts)
+
+    def could_match(self, known):
+        return any( self.index_pattern.fullmatch(known_path) for known_path in known )
+
+def match_property_paths(documents, paths):
+    # One traversal of every document for all paths at once. Returns, for each path,
+    # (document number, container, key, location) for every match.
+    matches = [ [] for _ in paths ]
+    for number, document in enumerate(documents):
+        walk_property_paths(document, [ (i, 0) for i in range(len(paths)) ], paths, matches, number, "")
+    return matches
+
+def walk_property_paths(node, states, paths, matches, document, location):
+    # states are (path, step) pairs still in play at node.
+    if isinstance(node, dict):
+        keys = set()
+        for path_id, position in states:
+            step = paths[path_id].steps[position]
+            if step[0] != "key":
+                keys = None
+                break
+            keys.add(step[1])
+        # When every path wants a named key, only those children are visited.
+        children = node.items() if keys is None else [ (key, node[key]) for key in keys if key in node ]
+    elif isinstance(node, list):
+        children = enumerate(node)
+    else:
+        return
 
-    def contains_property(self, file, file_property):
+    for key, child in children:
+        child_states = []
+        label = None
+        for path_id, position in states:
+            if not paths[path_id].step_matches(position, node, key, child):
+                continue
+            if position + 1 < len(paths[path_id].steps):
+                child_states.append((path_id, position + 1))
+                continue
+            label = label or path_label(location, key)
+            matches[path_id].append((document, node, key, label))
+        if len(child_states) > 0:
+            walk_property_paths(child, child_states, paths, matches, document, label or path_label(location, key))
+    return
+
+def scalar_span(text, line_starts, parent, key):
+    # Character range of the scalar parent[key] in text, from the position the round-trip loader recorded.
+    # None when it can't safely be patched in place: flow collections, block or multi-line scalars,
+    # anchors, tags, aliases, nulls and anything that isn't a scalar.
+    value = parent[key]
+    if value is None or not isinstance(value, (str, int, float)) or not hasattr(parent, 'lc') or parent.fa.flow_style():
+        return None
+    # Keys pulled in through a merge key (<<: *base) have no position of their own in parent.
+    if key not in parent.lc.data:
+        return None
+    try:
+        if isinstance(parent, list):
+            line, col = parent.lc.item(key)
+        else:
+            line, col = parent.lc.value(key)
+            indent = parent.lc.key(key)[1]
+    except (AttributeError, KeyError, IndexError, TypeError):
+        return None
+    if line >= len(line_starts):
+        return None
+    start = line_starts[line] + col
+    # A continuation line would be indented past the key, or past the "-" of a list item.
+    if isinstance(parent, list):
+        indent = text.rfind("-", line_starts[line], start) - line_starts[line]
+        if indent < 0:
+            return None
+    line_end = line_starts[line + 1] - 1 if line + 1 < len(line_starts) else len(text)
+    if start >= line_end or text[start] in "|>&!*{[":
+        return None
+
+    quote = text[start]
+    if quote in "'\"":
+        i = start + 1
+        while i < line_end:
+            if quote == "'" and text[i:i + 2] == "''" or quote == '"' and text[i] == "\\":
+                i += 2
+            elif text[i] == quote:
+                return start, i + 1
+            else:
+                i += 1
+        return None
+
+    # Plain scalar: up to a comment or the end of the line, and it mustn't continue on the next line.
+    end = text.find(" #", start, line_end)
+    end = (line_end if end == -1 else end)
+    while end > start and text[end - 1] in " \t\r":
+        end -= 1
+    if isinstance(value, str) and text[start:end] != value:
+        return None
+    for next_line in range(line + 1, len(line_starts)):
+        content = text[line_starts[next_line]:line_starts[next_line + 1] if next_line + 1 < len(line_starts) else len(text)]
+        stripped = content.strip()
+        if stripped == "":
+            continue
+        if not stripped.startswith("#") and len(content) - len(content.lstrip(" ")) > indent:
+            return None
+        break
+    return start, end
+
+def atomic_write(file, content):
+    # Write a temp file next to file and rename it over, so a killed run never leaves a half written file
+    # and readers only ever see the old or the new one. content is text, or anything else as JSON.
+    # A symlinked file is written through to its target, as open(file, 'w') would, not replaced by a copy.
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    file = path.realpath(file)
+    # Named per process and thread, so concurrent writers of the same file never share a temp file.
+    temp_path = path.join(path.dirname(file), f".{path.basename(file)}.{getpid()}.{get_ident()}.tmp")
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(content.encode())
+        if path.exists(file):
+            chmod(temp_path, stat(file).st_mode & 0o7777)
+        replace(temp_path, file)
+    except BaseException:
+        if path.exists(temp_path):
+            remove(temp_path)
+        raise
+    return
+
+def ignore_dirs(defaults):
+    # Directory names to prune from the walk, defaults plus the comma separated IGNORE_DIRS.
+    return set(defaults + [ d.strip() for d in env.get('IGNORE_DIRS', '').split(',') if d.strip() ])
+
+def walk_files(ignore):
+    # Lazily walk the checkout, pruning ignored directories in place so walk never enters them.
+    # The walk span only counts time spent walking, not the time callers spend on each file.
+    start, elapsed, directories, count = time(), 0.0, 0, 0
+    clock = perf_counter()
+    for root, dirs, files in walk('.'):
+        dirs[:] = sorted( d for d in dirs if d not in ignore )
+        directories += 1
+        count += len(files)
+        elapsed += perf_counter() - clock
+        for file in sorted(files):
+            yield path.join(root, file)
+        clock = perf_counter()
+    elapsed += perf_counter() - clock
+    tracer.record("walk", start, elapsed, { "directories": directories, "files": count })
+
+def git_files(git_args, ignore):
+    # Paths from a git command run in the current directory, relative to it and spelled like walk_files spells them.
+    import subprocess
+    with tracer.span("git", command = git_args[0]) as trace:
         try:
-            with open(file, 'r') as f:
-                data = f.read()
-            data = self.yaml.load(data)
-        except:
-            return False
-        properties_list = file_property.split('.')
-        return self.follow_properties(properties_list, data)
+            r = subprocess.run([ "git" ] + git_args, capture_output = True)
+        except OSError as e:
+            raise Exception(f"Unable to run git: {e}")
+        if r.returncode != 0:
+            raise Exception(f"git {' '.join(git_args)} failed: {r.stderr.decode(errors = 'replace').strip()}")
+        # -z output is NUL separated and never quoted. Unmerged files are listed once per stage.
+        files = list(dict.fromkeys( name for name in r.stdout.decode(errors = 'surrogateescape').split("\0") if name ))
+        trace.set(files = len(files))
+    for file in files:
+        if not any( part in ignore for part in file.split("/")[:-1] ):
+            yield path.join('.', *file.split("/"))
+
+def git_tracked_files(ignore):
+    # Everything in the git index; no directory walk, and untracked scratch files are never seen.
+    return git_files([ "ls-files", "-z", "--cached" ], ignore)
+
+def git_changed_files(ref, ignore):
+    # Files added, modified, renamed or copied on HEAD's side since ref (its merge base with HEAD, so a diverged ref works too).
+    return git_files([ "diff", "--name-only", "-z", "--relative", "--find-renames", "--diff-filter=ACMR", f"{ref}...HEAD", "--" ], ignore)
+
+def cache_path(name):
+    # Local state is kept inside .git by default so it sits next to the checkout but never gets committed.
+    if path.isdir('.git'):
+        return path.join('.git', name)
+    return '.' + name
+
+def index_path():
+    return env.get('CRGEN_INDEX', cache_path('crgen-index.json'))
+
+property_indexes = {}
+
+def open_property_index(index_path):
+    # Indexes stay loaded between runs in the same process (serve), unless someone else rewrote the file.
+    index = property_indexes.get(index_path)
+    if index is None or index.file_stamp() != index.loaded_stamp:
+        index = property_indexes[index_path] = property_index(index_path)
+    return index
+
+
+class property_index:
+    # Persistent map of file -> every dotted property path in it, keyed on content hash.
+    # mtime/size are the fast check; the hash decides when only the mtime moved (e.g. after a checkout).
+    VERSION = 2
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = {}
+        self.dirty = False
+        self.load()
+        self.loaded_stamp = self.file_stamp()
+        return
 
+    def file_stamp(self):
+        try:
+            st = stat(self.index_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
 
-    def update_property(self, file):
-        update_properties = [ prop for prop in env['YAML_PROPERTY'].split(',') ]
-
-        for propertystring in update_properties:
-            if self.contains_property(file, propertystring):
-                with open(file, 'r') as f:
-                    data = f.read()
-                data = self.yaml.load(data)
-                if self.set_property(propertystring.split('.'), data, env['NEW_VALUE']):
-                    with open(file, 'w') as f:
-                        self.yaml.dump(data, f)
-                else:
-                    print("Unable to update property in", file)
-            else:
-                print("File", file, "does not contain property", propertystring)
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get('version') != self.VERSION or not isinstance(data.get('files'), dict):
+            print(f"Discarding incompatible index {self.index_path}.", file=sys.stderr)
+            self.dirty = True
+            return
+        self.entries = data['files']
+        return
 
+    def save(self):
+        if not self.dirty:
+            return
+        atomic_write(self.index_path, { "version": self.VERSION, "files": self.entries })
+        self.dirty = False
+        self.loaded_stamp = self.file_stamp()
+        return
 
-    def find_files(self):
-        file_paths = self.find_all_files()
+    def lookup(self, file):
+        # Returns the recorded property paths for file, or None if it has to be parsed.
+        entry = self.entries.get(file)
+        if entry is None:
+            return None
+        try:
+            st = stat(file)
+        except OSError:
+            return None
+        if st.st_size != entry['size']:
+            return None
+        if st.st_mtime_ns != entry['mtime']:
+            with open(file, 'rb') as f:
+                if sha256(f.read()).hexdigest() != entry['sha256']:
+                    return None
+            entry['mtime'] = st.st_mtime_ns
+            self.dirty = True
+        return entry['properties']
+
+    def record(self, file, entry):
+        self.entries[file] = entry
+        self.dirty = True
+        return
+
+    def filter(self, files, paths, stats):
+        # Drop files the index already knows don't contain any of the property paths.
+        for file in files:
+            known = self.lookup(file)
+            if known is not None and not any( p.could_match(known) for p in paths ):
+                stats['indexed'] += 1
+                continue
+            yield file
+
+    def rebuild(self, files, workers):
+        self.entries = {}
+        self.dirty = True
+        if workers == 1:
+            results = map(index_file_worker, files)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers = workers, initializer = set_args, initargs = (args,))
+            results = pool.map(index_file_worker, files, chunksize = 16)
+        count = 0
+        for file, entry in results:
+            self.record(file, entry)
+            count += 1
+        if workers != 1:
+            pool.shutdown()
+        self.save()
+        print(f"Indexed {count} files into {self.index_path}.", file=sys.stderr)
+        return
+
+    @staticmethod
+    def property_paths(data, prefix = ""):
+        # Every path reachable through mappings and lists, spelled the way path_label spells match locations.
+        paths = []
+        if isinstance(data, dict):
+            items = data.items()
+        elif isinstance(data, list):
+            items = enumerate(data)
+        else:
+            return paths
+        for key, value in items:
+            label = path_label(prefix, key)
+            paths.append(label)
+            paths += property_index.property_paths(value, label)
+        return paths
+
+    @staticmethod
+    def entry_for(file, documents):
+        with open(file, 'rb') as f:
+            content = f.read()
+        st = stat(file)
+        return {
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha256": sha256(content).hexdigest(),
+            "properties": list(dict.fromkeys( known for document in documents or [] for known in property_index.property_paths(document) ))
+        }
+
+
+def index_file_worker(file):
+    # Parses a file for property_index.rebuild. Unparseable files are recorded with no properties.
+    try:
+        with open(file, 'r') as f:
+            documents = list(round_trip_yaml().load_all(f))
+    except Exception:
+        documents = None
+    return file, property_index.entry_for(file, documents)
 
-        # filter yaml files only
-        file_paths = [ file for file in file_paths if file.lower().endswith(".yml") or file.lower().endswith(".yaml") ]
 
-        # optionally filter on FILENAME_FILTER
-        if env['FILENAME_FILTER'] != "*":
-            file_paths = [ file for file in file_paths if env['FILENAME_FILTER'].lower() in file.lower() ]
+_worker_updater = None
 
-        # optionally filter on SUBFOLDER_FILTER
-        if env['SUBFOLDER_FILTER'] != "*":
-            file_paths = [ file for file in file_paths if env['SUBFOLDER_FILTER'].lower() in file.lower() ]
+def update_file_worker(file):
+    # Runs in the pool (or inline for the serial path). Output is captured and
+    # handed back so the parent prints it in file order.
+    global _worker_updater
+    if _worker_updater is None:
+        _worker_updater = deployment_updater()
+    _worker_updater.stats = { "parsed": 0, "written": 0, "unchanged": 0 }
+    _worker_updater.loaded = None
+    mark = tracer.mark()
+
+    output = StringIO()
+    updated, error, entry = [], None, None
+    with redirect_stdout(output):
+        try:
+            updated = _worker_updater.update_property(file)
+            if _worker_updater.index is not None:
+                entry = property_index.entry_for(file, _worker_updater.loaded)
+        except Exception as e:
+            error = str(e)
+    return file, updated, output.getvalue(), error, _worker_updater.stats, entry, tracer.take(mark)
 
-        # filter on files containing the property
-        file_paths = [ file for file in file_paths if any([ self.contains_property(file, file_property) for file_property in env['YAML_PROPERTY'].split(',') ]) ]
 
-        return file_paths
+user_templates = {}
+template_lock = Lock()
+TEMPLATE_CACHE_VERSION = 1
+REQUIRED_TEMPLATE_VALUES = [ "business_service", "cmdb_name", "request_group", "assignment_group" ]
+
+def default_cr_creation_path():
+    dir_path = path.dirname(path.realpath(__file__))
+    return path.realpath(f"{dir_path}{sep}..{sep}..{sep}cr_creation.yml")
+
+def parse_placeholders(value):
+    # Pre-parsed str.format fields, or None if the string isn't a valid format string (it'll fail at render time like before).
+    try:
+        return [ list(field) for field in Formatter().parse(value) ]
+    except ValueError:
+        return None
+
+def compile_user_template(content):
+    # Validates a cr_creation.yml once and pre-parses its placeholders. Nothing here needs comments
+    # preserved, so it's a safe load (C backed when ruamel.yaml.clib is installed).
+    import ruamel.yaml
+    data = ruamel.yaml.YAML(typ='safe', pure=False).load(content)
+    if not isinstance(data, dict):
+        data = {}
+    compiled = {
+        "data": data,
+        "missing": [ varname for varname in REQUIRED_TEMPLATE_VALUES if varname not in data.keys() ],
+        "placeholders": { key: parse_placeholders(value) for key, value in data.items() if isinstance(value, str) and (key.startswith("default_") or key == "u_functionality_testing") },
+        "tslc_error": None
+    }
+    if "y" in str(data.get('u_tslc_project', '')).lower() and data.get('u_tslc_activity') not in templater.tslc_activity_options:
+        compiled['tslc_error'] = f"Invalid value for 'u_tslc_activity' in cr_template.yaml. Must be (case sensitive) one of: {templater.tslc_activity_options}"
+    return compiled
+
+def load_compiled_template(cr_creation_path):
+    # Compiled templates are kept in memory per path and on disk keyed by the file's sha256,
+    # so an unchanged cr_creation.yml is never parsed as YAML again. Returns None if the file is missing.
+    with template_lock:
+        try:
+            st = stat(cr_creation_path)
+            stamp = (st.st_mtime_ns, st.st_size)
+            if cr_creation_path in user_templates.keys() and user_templates[cr_creation_path][0] == stamp:
+                return user_templates[cr_creation_path][1]
+            with open(cr_creation_path, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        digest = sha256(content).hexdigest()
+
+        cache_file = env.get('CR_TEMPLATE_CACHE', cache_path('crgen-templates.json'))
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache.get('version') != TEMPLATE_CACHE_VERSION:
+                cache = {}
+        except (OSError, ValueError, AttributeError):
+            cache = {}
+        templates = cache.setdefault('templates', {})
+
+        entry = templates.get(cr_creation_path)
+        if entry is not None and entry.get('sha256') == digest:
+            compiled = entry['compiled']
+        else:
+            compiled = compile_user_template(content)
+            templates[cr_creation_path] = { "sha256": digest, "compiled": compiled }
+            cache['version'] = TEMPLATE_CACHE_VERSION
+            try:
+                atomic_write(cache_file, cache)
+            except (OSError, TypeError, ValueError):
+                # Values JSON can't hold (e.g. YAML timestamps) just mean this template isn't cached on disk.
+                pass
+
+        user_templates[cr_creation_path] = (stamp, compiled)
+        return compiled
+
+def render_placeholder(compiled, key, varmap):
+    # Fills a pre-parsed template value; equivalent to compiled['data'][key].format(**varmap).
+    value = compiled['data'][key]
+    parsed = compiled['placeholders'].get(key)
+    if parsed is None:
+        return value.format(**varmap)
+    rendered = []
+    for literal, field, format_spec, conversion in parsed:
+        rendered.append(literal)
+        if field is None:
+            continue
+        # Attribute/index lookups, positional and nested fields are left to str.format.
+        if not field.isidentifier() or "{" in (format_spec or ""):
+            return value.format(**varmap)
+        fieldvalue = varmap[field]
+        if conversion == "r":
+            fieldvalue = repr(fieldvalue)
+        elif conversion == "s":
+            fieldvalue = str(fieldvalue)
+        elif conversion == "a":
+            fieldvalue = ascii(fieldvalue)
+        rendered.append(format(fieldvalue, format_spec or ""))
+    return "".join(rendered)
 
 
 class templater:
     REQ_VAR = [ "ENVIRONMENT", "NEW_VALUE", "SUBFOLDER_FILTER", "FILENAME_FILTER", "PR_NUMBER", "CR_NUMBER", "REPO", "ACTOR", "CORRELATION_URL" ]
     VARMAP = None
-    yaml = ruamel.yaml.YAML()
 
     tslc_activity_options = [
         "Application Configuration Change",
@@ -217,50 +1347,54 @@ class templater:
     ]
 
 
-    def __init__(self):
+    def __init__(self, overrides = None, simple = None):
+        # overrides replace environment variables, which is how cr_batch and serve feed in each request.
+        self.simple = args.simple if simple is None else simple
+        self.vars = dict(env)
+        if overrides is not None:
+            self.vars.update(overrides)
         for v in self.REQ_VAR:
-            if v not in env.keys():
+            if v not in self.vars.keys():
                 raise Exception(f"Environment variable missing: '" + v + "' must be set.")
         self.VARMAP = dict()
         for v in self.REQ_VAR:
-            self.VARMAP[v] = env[v]
+            self.VARMAP[v] = self.vars[v]
 
-        self.argocd_server = env['ARGOCD_SERVER'].format(env = env['ENVIRONMENT'].lower())
-        if "https://" not in self.argocd_server:
+        self.argocd_server = self.vars['ARGOCD_SERVER'].format(env = self.vars['ENVIRONMENT'].lower())
+        if "://" not in self.argocd_server:
             self.argocd_server = "https://" + self.argocd_server
-        self.requesting_user = env['ACTOR'].replace("usps", "").replace("-", " ").strip().title()
+        self.requesting_user = self.vars['ACTOR'].replace("usps", "").replace("-", " ").strip().title()
         return
 
     def load_user_template(self):
-        dir_path = path.dirname(path.realpath(__file__))
-
-        cr_creation_path = f"{dir_path}{sep}..{sep}..{sep}cr_creation.yml"
-        cr_creation_path = path.realpath(cr_creation_path)
-
-        if not path.exists(cr_creation_path):
-            exit(f"Missing {cr_creation_path}")
-
-        with open(cr_creation_path) as f:
-            data = self.yaml.load(f)
-
-        required_template_values = [ "business_service", "cmdb_name", "request_group", "assignment_group" ]
-        for varname in required_template_values:
-            if varname not in data.keys():
-                exit(f"{varname} is required but missing from {cr_creation_path}")
-
-        for varname in data.keys():
-            if "default_" in varname:
-                print(f"Found optional variable {varname} - this will override a default value.")
+        # Each distinct cr_creation.yml is only compiled once; see load_compiled_template.
+        cr_creation_path = path.realpath(self.vars.get('CR_CREATION', default_cr_creation_path()))
+        first_load = cr_creation_path not in user_templates.keys()
+        self.compiled = load_compiled_template(cr_creation_path)
+        if self.compiled is None:
+            sys.exit(f"Missing {cr_creation_path}")
+
+        for varname in self.compiled['missing']:
+            sys.exit(f"{varname} is required but missing from {cr_creation_path}")
+
+        data = self.compiled['data']
+        if first_load:
+            for varname in data.keys():
+                if "default_" in varname:
+                    print(f"Found optional variable {varname} - this will override a default value.", file=sys.stderr)
 
         return data
 
+    def render(self, key):
+        return render_placeholder(self.compiled, key, self.VARMAP)
+
     def generate_cr_template(self):
         data = self.load_user_template()
 
         five_minutes_from_now = int(time()) + 300
         three_days_from_now = int(time()) + (86400 * 3) + 3600
         seven_days_from_now = int(time()) + (86400 * 7) + 3600
-        if "p" in env['ENVIRONMENT'].lower():
+        if "p" in self.vars['ENVIRONMENT'].lower():
             start_date = strftime('%Y-%m-%d %H:%M:%S', localtime( three_days_from_now ) )
             end_date = strftime('%Y-%m-%d %H:%M:%S', localtime( seven_days_from_now ) )
         else:
@@ -283,7 +1417,7 @@ class templater:
                 },
                 "requested_by": { "name": self.requesting_user },
                 "u_requesting_group": data['request_group'],
-                "u_environment": env['ENVIRONMENT'],
+                "u_environment": self.vars['ENVIRONMENT'],
                 "start_date": start_date,
                 "end_date": end_date,
                 "category": "DevOps",
@@ -293,19 +1427,19 @@ class templater:
                 "u_pci_inscope": data['pci_in_scope'],
                 "u_tslc_project": data['u_tslc_project'],
                 "assignment_group": { "name": data['assignment_group'] },
-                "short_description": f"Update {data['cmdb_name']} in {env['ENVIRONMENT']} to {env['NEW_VALUE']}",
-                "description": f"Update application {data['cmdb_name']} environment {env['ENVIRONMENT']} to version {env['NEW_VALUE']}.",
+                "short_description": f"Update {data['cmdb_name']} in {self.vars['ENVIRONMENT']} to {self.vars['NEW_VALUE']}",
+                "description": f"Update application {data['cmdb_name']} environment {self.vars['ENVIRONMENT']} to version {self.vars['NEW_VALUE']}.",
                 "justification": "Enhancements, bug fixes, other normal development activity.",
                 "implementation_plan": "Deployment will be deployed via ArgoCD.",
                 "backout_plan": "We will either use the rollback option in the deployment tool, or the previous version will be redeployed again via the github orchestration process.",
                 "test_plan": "Development team will verify application connectivity and operation during deployment/maintenance window.",
                 "correlation_display": "GitHub Actions",
-                "correlation_id": env['CORRELATION_URL'],
+                "correlation_id": self.vars['CORRELATION_URL'],
             }
         }
 
-        if not args.simple:
-            crtemplate['attributes']['u_devops_endpoint'] = f"/repos/usps/{env['REPO']}/dispatches"
+        if not self.simple:
+            crtemplate['attributes']['u_devops_endpoint'] = f"/repos/usps/{self.vars['REPO']}/dispatches"
             crtemplate['attributes']['chg_model'] = { "name": "DevOps Simplified" }
 
 
@@ -314,52 +1448,52 @@ class templater:
             self.VARMAP['requesting_user'] = requesting_user
 
         if "default_implementation_plan" in data.keys():
-            crtemplate['attributes']['implementation_plan'] = data['default_implementation_plan'].format(**self.VARMAP)
+            crtemplate['attributes']['implementation_plan'] = self.render('default_implementation_plan')
 
         if "y" in data['pci_in_scope'].lower():
-            crtemplate['attributes']['u_functionality_testing'] = data['u_functionality_testing'].format(**self.VARMAP)
+            crtemplate['attributes']['u_functionality_testing'] = self.render('u_functionality_testing')
 
         if "y" in data['u_tslc_project'].lower():
             crtemplate['attributes']['u_tslc_project_id'] = { "u_tslc_project_id": data['u_tslc_project_id'] }
             crtemplate['attributes']['u_tslc_activity'] = { "u_tslc_activity": data['u_tslc_activity'] }
-            if data['u_tslc_activity'] not in self.tslc_activity_options:
-                raise Exception(f"Invalid value for 'u_tslc_activity' in cr_template.yaml. Must be (case sensitive) one of: {self.tslc_activity_options}")
+            if self.compiled['tslc_error'] is not None:
+                raise Exception(self.compiled['tslc_error'])
 
         if "default_short_description" in data.keys():
-            crtemplate['attributes']['short_description'] = data['default_short_description'].format(**self.VARMAP)
+            crtemplate['attributes']['short_description'] = self.render('default_short_description')
 
         if "default_description" in data.keys():
-            crtemplate['attributes']['description'] = data['default_description'].format(**self.VARMAP)
+            crtemplate['attributes']['description'] = self.render('default_description')
 
         if "default_justification" in data.keys():
-            crtemplate['attributes']['justification'] = data['default_justification'].format(**self.VARMAP)
+            crtemplate['attributes']['justification'] = self.render('default_justification')
 
         if "default_backout_plan" in data.keys():
-            crtemplate['attributes']['backout_plan'] = data['default_backout_plan'].format(**self.VARMAP)
+            crtemplate['attributes']['backout_plan'] = self.render('default_backout_plan')
 
         if "default_test_plan" in data.keys():
-            crtemplate['attributes']['test_plan'] = data['default_test_plan'].format(**self.VARMAP)
+            crtemplate['attributes']['test_plan'] = self.render('default_test_plan')
 
         return crtemplate
 
     def generate_implementation_plan(self):
         data = self.load_user_template()
 
-        u_devops_endpoint = f"/repos/usps/{env['REPO']}/dispatches"
+        u_devops_endpoint = f"/repos/usps/{self.vars['REPO']}/dispatches"
 
         u_devops_payload = {
             "event_type": "SNOW Deployment Request Callback",
             "client_payload": {
-                "pr_number": env['PR_NUMBER'],
-                "cr_number": env['CR_NUMBER'],
-                "server": env['SNOW_SERVER_ENV'],
-                "deployenv": env['ENVIRONMENT'],
+                "pr_number": self.vars['PR_NUMBER'],
+                "cr_number": self.vars['CR_NUMBER'],
+                "server": self.vars['SNOW_SERVER_ENV'],
+                "deployenv": self.vars['ENVIRONMENT'],
                 "argocd_server": self.argocd_server,
-                "argocd_apps": env['ARGOCD_APPS']
+                "argocd_apps": self.vars['ARGOCD_APPS']
             }
         }
 
-        if args.simple:
+        if self.simple:
             containerized_implementation_plan = {}
         else:
             containerized_implementation_plan = {
@@ -378,166 +1512,972 @@ class templater:
             f.write(json.dumps(self.generate_implementation_plan()))
 
 
+class cr_batch:
+    # Generates one CR per row of a manifest instead of one per process.
+    # Rows are JSON Lines, or CSV with a header when the file ends in .csv. Each row
+    # is a set of overrides for templater's environment variables (ENVIRONMENT, NEW_VALUE, REPO, ...),
+    # plus an optional CR_CREATION path for services with their own cr_creation.yml.
+    def __init__(self, manifest, out_dir = None):
+        self.manifest = manifest
+        self.out_dir = out_dir
+        self.errors = 0
+        return
+
+    def read_rows(self):
+        # CSV rows come out as dicts, JSON Lines rows as the raw line so generate can report a bad one and go on.
+        if self.manifest == "-":
+            source = sys.stdin
+        else:
+            source = open(self.manifest, newline = '')
+        with source:
+            if self.manifest.lower().endswith(".csv"):
+                import csv
+                yield from csv.DictReader(source)
+                return
+            for line in source:
+                if line.strip():
+                    yield line
+
+    def generate(self):
+        # Writes {"row": n, "cr": {...}} (or {"row": n, "error": "..."}) per row to stdout as JSON Lines,
+        # or cr-<n>.json per successful row into out_dir. Returns True if any row failed.
+        for row_number, row in enumerate(self.read_rows(), start = 1):
+            try:
+                if isinstance(row, str):
+                    row = json.loads(row)
+                    if not isinstance(row, dict):
+                        raise Exception("Row is not a JSON object")
+                # A null (or a missing CSV column) leaves the variable unset rather than the string "None".
+                row = { key: str(value) for key, value in row.items() if value is not None }
+                cr = templater(row).generate_cr_template()
+            except (Exception, SystemExit) as e:
+                self.errors += 1
+                print(f"Row {row_number}: {e}", file=sys.stderr)
+                if self.out_dir is None:
+                    print(json.dumps({ "row": row_number, "error": str(e) }), flush = True)
+                continue
+
+            if self.out_dir is None:
+                print(json.dumps({ "row": row_number, "cr": cr }), flush = True)
+            else:
+                with open(path.join(self.out_dir, f"cr-{row_number}.json"), "w") as f:
+                    f.write(json.dumps(cr))
+
+        if self.errors > 0:
+            print(f"{self.errors} rows failed.", file=sys.stderr)
+        return self.errors > 0
+
+
+applist_cache_lock = Lock()
+
+def secret_name(argocd_server):
+    return re.sub(r'\W+', '', argocd_server.replace("https://","").replace("/","")).upper()
+
+def argocd_targets():
+    # Every (server, environment) pair from the comma separated ARGOCD_SERVER and ENVIRONMENT,
+    # with {env} filled in. A server without {env} only appears once.
+    targets = []
+    for environment in [ e.strip() for e in env['ENVIRONMENT'].split(',') if e.strip() ]:
+        for server in [ s.strip() for s in env['ARGOCD_SERVER'].split(',') if s.strip() ]:
+            server = server.format(env = environment.lower())
+            if server not in [ t[0] for t in targets ]:
+                targets.append((server, environment))
+    return targets
+
+
 class argocd_syncer:
     REQ_VAR = [ "ARGOCD_TOKEN", "ARGOCD_SERVER", "ARGOCD_APPS", "ENVIRONMENT", "REPO" ]
-    yaml = ruamel.yaml.YAML()
+    APPLIST_CACHE_VERSION = 2
 
-    def __init__(self):
+    def __init__(self, argocd_server = None, environment = None, label = None):
+        # argocd_server/environment default to ARGOCD_SERVER/ENVIRONMENT; argocd_fanout passes one target each.
+        # label tags every log line, so output from concurrent clusters can be told apart.
         for v in self.REQ_VAR:
             if v not in env.keys():
                 raise Exception(f"Missing environment variable: {v} must be defined.")
-        self.argocd_server = env['ARGOCD_SERVER'].format(env = env['ENVIRONMENT'].lower())
-        if "https://" not in self.argocd_server:
+        self.environment = environment or env['ENVIRONMENT']
+        self.label = label
+        self.argocd_server = (argocd_server or env['ARGOCD_SERVER']).format(env = self.environment.lower())
+        # Clusters can each have their own token, named after the server the same way --secretname does.
+        token = env.get(f"ARGOCD_TOKEN_{secret_name(self.argocd_server)}", env['ARGOCD_TOKEN'])
+        if "://" not in self.argocd_server:
             self.argocd_server = "https://" + self.argocd_server
-        self.argocd_headers = { "Content-type": "application/json", "Authorization": "Bearer " + env['ARGOCD_TOKEN'] }
+        self.argocd_headers = { "Content-type": "application/json", "Authorization": "Bearer " + token }
+        self.http = get_http_client()
+        self.applist_cache_path = env.get('ARGOCD_APP_CACHE', cache_path('crgen-argocd-apps.json'))
+        # How many sync requests may be in flight at once.
+        self.sync_concurrency = max(1, int(env.get('ARGOCD_SYNC_CONCURRENCY', 8)))
+        # Sync waves: apps are synced wave by wave, at most max_in_flight of a wave at a time (0 is the whole wave).
+        # Waves come from argocd_sync_waves in cr_creation.yml, or from the label/annotation named by ARGOCD_WAVE_KEY.
+        self.wave_key = env.get('ARGOCD_WAVE_KEY', '').strip()
+        self.max_in_flight = int(env.get('ARGOCD_WAVE_MAX_IN_FLIGHT', 0))
+        # ARGOCD_FAIL_FAST stops scheduling as soon as an app fails; ARGOCD_ROLLBACK then rolls back every app this run synced.
+        self.fail_fast = env.get('ARGOCD_FAIL_FAST', '').lower() in [ "1", "true", "yes" ]
+        self.rollback = env.get('ARGOCD_ROLLBACK', '').lower() in [ "1", "true", "yes" ]
+        self.sync_errors = {}
+        self.app_waves = {}
+        self.rollback_ids = {}
+        # operationState.startedAt of each app's previous operation, as of our sync request. Until the
+        # app reports a newer one, whatever operationState it shows belongs to that earlier operation.
+        self.previous_operations = {}
         self.load_user_template()
-        self.populate_applist()
+        with tracer.span("argocd.discover", cluster = self.argocd_server):
+            self.populate_applist()
+        return
+
+    def log(self, *message):
+        if self.label is None:
+            print(*message, file=sys.stderr)
+        else:
+            print(f"[{self.label}]", *message, file=sys.stderr)
         return
 
     def printlist(self, thelist, theheader):
         if len(thelist) == 0:
             return
-        print(theheader, file=sys.stderr)
+        self.log(theheader)
         for item in thelist:
-            print(" ", item, file=sys.stderr)
-        print("", file=sys.stderr)
+            self.log(" ", item)
+        self.log("")
         return
 
     def load_user_template(self):
-        dir_path = path.dirname(path.realpath(__file__))
-        cr_creation_path = f"{dir_path}{sep}..{sep}..{sep}cr_creation.yml"
-        cr_creation_path = path.realpath(cr_creation_path)
-
-        if not path.exists(cr_creation_path):
+        cr_creation_path = default_cr_creation_path()
+        compiled = load_compiled_template(cr_creation_path)
+        if compiled is None:
             raise Exception(f"Missing {cr_creation_path}")
 
-        with open(cr_creation_path) as f:
-            data = self.yaml.load(f)
-
-        self.user_template_data = data
+        self.user_template_data = compiled['data']
         return
 
     def execute(self):
-        self.init_argo_syncs()
-        return self.monitor_argo_syncs()
+        # Without waves configured this is a single wave holding every app, all of them in flight at once.
+        self.app_states = {}
+        self.sync_errors = {}
+        waves = self.sync_waves()
+        synced, skipped = [], []
+        stopped = False
+        for number, (wave, max_in_flight) in enumerate(waves):
+            if len(waves) > 1 and not stopped:
+                self.printlist(wave, f"Sync wave {number + 1} of {len(waves)}, {max_in_flight or len(wave)} at a time:")
+            batch_size = max_in_flight or len(wave)
+            for i in range(0, len(wave), batch_size):
+                if stopped:
+                    skipped += wave[i:i + batch_size]
+                    continue
+                with tracer.span("argocd.sync", cluster = self.argocd_server, wave = number + 1, apps = len(wave[i:i + batch_size])):
+                    started = self.init_argo_syncs(wave[i:i + batch_size])
+                synced += started
+                # Only monitor what actually started; apps that failed to start already count as a failure.
+                if len(started) > 0:
+                    with tracer.span("argocd.monitor", cluster = self.argocd_server, wave = number + 1, apps = len(started)):
+                        self.monitor_argo_syncs(started)
+                failed = list(self.sync_errors.keys()) + [ app_name for app_name in started if self.app_failed(app_name) ]
+                if self.fail_fast and len(failed) > 0:
+                    self.log(f"Stopping after wave {number + 1}, these apps failed: {', '.join(failed)}")
+                    stopped = True
+
+        if len(synced) == 0:
+            self.log("No syncs could be started.")
+            return False
+        self.printlist(skipped, "Not synced because an earlier app failed:")
+        if stopped and self.rollback:
+            self.rollback_syncs(synced)
+        return self.report_argo_syncs(synced) and len(self.sync_errors) == 0 and len(skipped) == 0
+
+    def sync_waves(self):
+        # [(apps, max_in_flight)] in the order they're synced.
+        template_waves = self.user_template_data.get('argocd_sync_waves')
+        if template_waves:
+            return self.template_sync_waves(template_waves)
+        if not self.wave_key:
+            return [ (self.apps_to_sync, self.max_in_flight) ]
+        numbers = sorted(set( self.app_waves.get(app_name, 0) for app_name in self.apps_to_sync ))
+        return [ ([ app_name for app_name in self.apps_to_sync if self.app_waves.get(app_name, 0) == n ], self.max_in_flight) for n in numbers ]
+
+    def template_sync_waves(self, template_waves):
+        # argocd_sync_waves is a list of waves, each a list (or comma separated string) of app names or
+        # glob patterns, or a mapping with "apps" and its own "max_in_flight". An app goes into the first
+        # wave that matches it; apps no wave matches are synced in a last wave of their own.
+        waves, remaining = [], list(self.apps_to_sync)
+        for wave in template_waves:
+            max_in_flight = self.max_in_flight
+            if isinstance(wave, dict):
+                max_in_flight = int(wave.get('max_in_flight', max_in_flight))
+                wave = wave.get('apps') or []
+            if isinstance(wave, str):
+                wave = wave.split(',')
+            patterns = [ str(pattern).strip().lower() for pattern in wave if str(pattern).strip() ]
+            apps = [ app_name for app_name in remaining if any( fnmatch(app_name.lower(), pattern) for pattern in patterns ) ]
+            remaining = [ app_name for app_name in remaining if app_name not in apps ]
+            if len(apps) > 0:
+                waves.append((apps, max_in_flight))
+        if len(remaining) > 0:
+            waves.append((remaining, self.max_in_flight))
+        return waves
+
+    def load_applist_cache(self):
+        try:
+            with open(self.applist_cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != self.APPLIST_CACHE_VERSION:
+            return {}
+        return cache
+
+    def save_applist_cache(self, cache_key, value):
+        # Several clusters may be deploying at once, so re-read under the lock and only replace our key.
+        with applist_cache_lock:
+            cache = self.load_applist_cache()
+            cache[cache_key] = value
+            cache['version'] = self.APPLIST_CACHE_VERSION
+            try:
+                atomic_write(self.applist_cache_path, cache)
+            except OSError as e:
+                self.log(f"Unable to save app list cache: {e}")
+        return
+
+    def fetch_applist(self):
+        # Ask the server for just the names and source repos, filtered by project/selector when configured.
+        # The result is cached locally and revalidated with If-None-Match when the server sends an ETag.
+        params = { "fields": "items.metadata.name,items.spec.source.repoURL,items.spec.sources" }
+        if self.wave_key:
+            params['fields'] += ",items.metadata.labels,items.metadata.annotations"
+        if env.get('ARGOCD_PROJECTS', '').strip():
+            params['projects'] = [ project.strip() for project in env['ARGOCD_PROJECTS'].split(',') if project.strip() ]
+        if env.get('ARGOCD_SELECTOR', '').strip():
+            params['selector'] = env['ARGOCD_SELECTOR'].strip()
+
+        cache = self.load_applist_cache()
+        # The cached apps carry waves computed with ARGOCD_WAVE_KEY, so a different key can't reuse them.
+        cache_key = f"{self.argocd_server} {json.dumps(params, sort_keys = True)} {self.wave_key}"
+        cached = cache.get(cache_key)
+        headers = dict(self.argocd_headers)
+        if cached is not None:
+            headers['If-None-Match'] = cached['etag']
+
+        argocd_apps_path = f"{self.argocd_server}/api/v1/applications"
+        r = self.http.get( argocd_apps_path, headers = headers, params = params, verify = False, endpoint = "GET /api/v1/applications" )
+        self.log(f"Retrieved app list from {self.argocd_server} with code {r.status_code}.")
+        if r.status_code == 304 and cached is not None:
+            return cached['apps']
+        if r.status_code > 299:
+            sys.exit(1)
+
+        # ArgoCD sends "items": null rather than an empty list.
+        applist = []
+        for app in r.json().get('items') or []:
+            spec = app.get('spec', {})
+            sources = [ spec['source'] ] if 'source' in spec else []
+            sources += spec.get('sources') or []
+            applist.append({ "name": app['metadata']['name'], "repos": [ source.get('repoURL', '') for source in sources ], "wave": self.wave_of(app) })
+
+        if r.headers.get('ETag'):
+            self.save_applist_cache(cache_key, { "etag": r.headers['ETag'], "apps": applist })
+        return applist
+
+    def wave_of(self, app):
+        # The app's wave from its ARGOCD_WAVE_KEY label or annotation, 0 when it has none.
+        if not self.wave_key:
+            return 0
+        metadata = app.get('metadata', {})
+        value = (metadata.get('labels') or {}).get(self.wave_key, (metadata.get('annotations') or {}).get(self.wave_key, 0))
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            self.log(f"Ignoring {self.wave_key}={value} on {metadata.get('name')}, it isn't a number.")
+            return 0
 
     def populate_applist(self):
         # Determine which applications to sync, either based on git repo or from the user provided list.
-        argocd_apps_path = f"{self.argocd_server}/api/v1/applications"
-        argocd_applications = requests.get( argocd_apps_path, headers = self.argocd_headers, verify = False )
-        print(f"Retrieved app list from {self.argocd_server} with code {argocd_applications.status_code}.", file=sys.stderr)
-        if argocd_applications.status_code > 299:
-            exit(1)
-        argocd_applications = argocd_applications.json()['items']
+        argocd_applications = self.fetch_applist()
+        known_apps = { app['name'].lower(): app['name'] for app in argocd_applications }
+        self.app_waves = { app['name']: app.get('wave', 0) for app in argocd_applications }
 
         if env['ARGOCD_APPS'].strip() == "*":
-            self.apps_to_sync = [ app['metadata']['name'] for app in argocd_applications if env['REPO'].lower() in app['spec']['source']['repoURL'].lower() ]
+            self.apps_to_sync = [ app['name'] for app in argocd_applications if any( env['REPO'].lower() in repo.lower() for repo in app['repos'] ) ]
             self.printlist(self.apps_to_sync, f"We will be syncing the following applications on {self.argocd_server}\nDiscovered Application List:")
         else:
             user_provided_applist = [ app.strip().lower() for app in env['ARGOCD_APPS'].split(',') ]
-            self.apps_to_sync = [ app['metadata']['name'] for app in argocd_applications if app['metadata']['name'].lower() in user_provided_applist ]
+            self.apps_to_sync = [ known_apps[app] for app in user_provided_applist if app in known_apps ]
             self.printlist(self.apps_to_sync, f"We will be syncing the following applications on {self.argocd_server}\nVerified User-Provided Application List")
 
-        # Append template list if present and dedup.
+        # Append template list if present (a list or comma separated string), verified the same way, and dedup.
         if "default_argocd_applist" in self.user_template_data.keys():
-            self.apps_to_sync += default_argocd_applist['default_argocd_applist']
-            self.apps_to_sync = list(set(self.apps_to_sync))
-
+            default_applist = self.user_template_data['default_argocd_applist'] or []
+            if isinstance(default_applist, str):
+                default_applist = default_applist.split(',')
+            default_applist = [ str(app).strip().lower() for app in default_applist if str(app).strip() ]
+            self.printlist([ app for app in default_applist if app not in known_apps ], f"Applications in default_argocd_applist not found on {self.argocd_server}:")
+            self.apps_to_sync += [ known_apps[app] for app in default_applist if app in known_apps ]
+
+        self.apps_to_sync = sorted(set(self.apps_to_sync))
         if len(self.apps_to_sync) == 0:
-            print("No applications were found to sync.", file=sys.stderr)
-            exit(1)
-        self.apps_to_sync.sort()
-
-    def init_argo_syncs(self):
-        for app_name in self.apps_to_sync:
-            sync_endpoint_url = f"{self.argocd_server}/api/v1/applications/{app_name}/sync"
-            r = requests.post(sync_endpoint_url, headers = self.argocd_headers, verify = False)
+            self.log("No applications were found to sync.")
+            sys.exit(1)
+
+    def init_argo_sync(self, app_name):
+        # Returns None on success, or the error text.
+        sync_endpoint_url = f"{self.argocd_server}/api/v1/applications/{app_name}/sync"
+        try:
+            r = self.http.post(sync_endpoint_url, headers = self.argocd_headers, verify = False, endpoint = "POST /api/v1/applications/{app}/sync")
+        except self.http.request_error as e:
+            return str(e)
+        if r.status_code > 299:
+            return f"Error communicating with the ArgoCD Server: {r.text}"
+        # The sync response is the app as it was before this sync, so its newest history entry is what a rollback goes back to.
+        try:
+            status = r.json().get('status', {})
+        except ValueError:
+            status = {}
+        history = status.get('history') or []
+        self.previous_operations[app_name] = (status.get('operationState') or {}).get('startedAt')
+        if len(history) > 0:
+            self.rollback_ids[app_name] = history[-1]['id']
+        return None
+
+    def init_argo_syncs(self, apps):
+        # Start the syncs for apps concurrently, at most sync_concurrency at a time.
+        # Errors are collected per app in sync_errors rather than stopping at the first one. Returns the started apps.
+        started = []
+        errors = {}
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = self.sync_concurrency) as pool:
+            for app_name, error in zip(apps, pool.map(with_request_output(self.init_argo_sync), apps)):
+                if error is None:
+                    self.log(f"Initiated Sync for {app_name}.")
+                    started.append(app_name)
+                else:
+                    self.log(f"Unable to start sync for {app_name}. {error}")
+                    errors[app_name] = error
+
+        self.sync_errors.update(errors)
+        self.log("")
+        self.printlist(started, f"Started {len(started)} of {len(apps)} syncs:")
+        self.printlist(list(errors.keys()), "Failed to start:")
+        return started
+
+    def rollback_syncs(self, synced):
+        # Roll every app this run synced back to the deployment it had before. ArgoCD refuses to roll back
+        # an app with automated sync on, or one with an operation still running, so those are terminated first.
+        self.log("Rolling back:")
+        for app_name in synced:
+            app_url = f"{self.argocd_server}/api/v1/applications/{app_name}"
+            if app_name not in self.rollback_ids:
+                self.log(f"  {app_name}: no earlier deployment to roll back to.")
+                continue
+            data = json.dumps({ "name": app_name, "id": self.rollback_ids[app_name], "prune": False })
+            try:
+                if app_name not in self.app_states or self.sync_in_progress(self.app_states[app_name]):
+                    self.http.request("DELETE", f"{app_url}/operation", headers = self.argocd_headers, verify = False, endpoint = "DELETE /api/v1/applications/{app}/operation")
+                r = self.http.post(f"{app_url}/rollback", headers = self.argocd_headers, data = data, verify = False, endpoint = "POST /api/v1/applications/{app}/rollback")
+            except self.http.request_error as e:
+                self.log(f"  {app_name}: rollback failed. {e}")
+                continue
             if r.status_code > 299:
-                print(f"Error communicating with the ArgoCD Server: {r.text}", file=sys.stderr)
-                exit(1)
+                self.log(f"  {app_name}: rollback failed. {r.text}")
             else:
-                print(f"Initiated Sync for {app_name}.", file=sys.stderr)
+                self.log(f"  {app_name}: rolled back to history id {self.rollback_ids[app_name]}.")
+        self.log("")
         return
 
-    def monitor_argo_syncs(self):
+    def sync_status(self, app):
+        return app.get('status', {}).get('sync', {}).get('status', "Unknown")
+
+    def health_status(self, app):
+        return app.get('status', {}).get('health', {}).get('status', "Unknown")
+
+    def current_operation(self, app):
+        # The app's operationState once it belongs to our sync, None while it still shows an earlier one.
+        # A top level operation means the sync is queued and the controller hasn't picked it up yet.
+        if app.get('operation') is not None:
+            return None
+        operation_state = app.get('status', {}).get('operationState') or {}
+        app_name = app.get('metadata', {}).get('name')
+        if app_name in self.previous_operations:
+            # Right after the sync request the app can still show the previous operation, e.g. its Succeeded.
+            started, previous = operation_state.get('startedAt'), self.previous_operations[app_name]
+            if started is None or (previous is not None and started <= previous):
+                return None
+        return operation_state
+
+    def sync_in_progress(self, app):
+        operation_state = self.current_operation(app)
+        if operation_state is None:
+            return True
+        return self.sync_status(app) == "Progressing" or operation_state.get('phase') in [ "Running", "Terminating" ]
+
+    def observe(self, app):
+        # Record the latest state of an app, logging only when its sync/health status changes.
+        app_name = app['metadata']['name']
+        previous = self.app_states.get(app_name)
+        self.app_states[app_name] = app
+        current = (self.sync_in_progress(app), self.sync_status(app), self.health_status(app))
+        if previous is not None and current == (self.sync_in_progress(previous), self.sync_status(previous), self.health_status(previous)):
+            return False
+
+        if current[0]:
+            self.log(f"Sync in progress for {app_name}. {current[1]}.")
+        else:
+            self.log(f"Sync complete for {app_name}. {current[1]}.")
+            self.log(f"Health status: {current[2]}.")
+        return True
+
+    def syncs_complete(self):
+        return all( app_name in self.app_states and not self.sync_in_progress(self.app_states[app_name]) for app_name in self.in_flight )
+
+    def app_failed(self, app_name):
+        # Only the outcome of our own sync counts: an app that was Degraded or had a failed operation
+        # before it (often the reason for the redeploy) isn't failed until our operation says so.
+        # A failed operation counts right away, Degraded once the operation is over, anything else once the sync is.
+        app = self.app_states.get(app_name)
+        if app is None:
+            return False
+        operation_state = self.current_operation(app)
+        if operation_state is None:
+            return False
+        phase = operation_state.get('phase')
+        if phase in [ "Failed", "Error" ]:
+            return True
+        if phase in [ "Running", "Terminating" ]:
+            return False
+        return self.health_status(app) == "Degraded" or (not self.sync_in_progress(app) and self.health_status(app) != "Healthy")
+
+    def monitoring_done(self):
+        # With fail fast, monitoring stops the moment any app in flight fails.
+        return self.syncs_complete() or (self.fail_fast and any( self.app_failed(app_name) for app_name in self.in_flight ))
+
+    def watch_argo_syncs(self):
+        # Follow the application watch stream until every app has finished syncing.
+        # Returns False if the stream isn't available or ends early, so the caller can poll instead.
+        stream_url = f"{self.argocd_server}/api/v1/stream/applications"
+        # ApplicationQuery's name is a single value, so the stream can't be filtered to several apps by name.
+        # Narrow it by project/selector when those are set; events for other apps are skipped below.
+        params = {}
+        if env.get('ARGOCD_PROJECTS', '').strip():
+            params['projects'] = [ project.strip() for project in env['ARGOCD_PROJECTS'].split(',') if project.strip() ]
+        if env.get('ARGOCD_SELECTOR', '').strip():
+            params['selector'] = env['ARGOCD_SELECTOR'].strip()
+        read_timeout = float(env.get('ARGOCD_STREAM_TIMEOUT', 60))
+        with tracer.span("monitor.watch", cluster = self.argocd_server) as trace:
+            return self.follow_watch_stream(stream_url, params, read_timeout, trace)
+
+    def follow_watch_stream(self, stream_url, params, read_timeout, trace):
+        events = 0
+        try:
+            with self.http.get(stream_url, headers = self.argocd_headers, params = params, stream = True, verify = False, timeout = (self.http.timeout[0], read_timeout), endpoint = "GET /api/v1/stream/applications") as r:
+                if r.status_code > 299:
+                    self.log(f"Watch stream unavailable ({r.status_code}).")
+                    return False
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line).get('result', {})
+                    app = event.get('application')
+                    if app is None or app['metadata']['name'] not in self.in_flight or event.get('type') == "DELETED":
+                        continue
+                    events += 1
+                    trace.set(events = events)
+                    self.observe(app)
+                    if self.monitoring_done():
+                        return True
+        except (self.http.request_error, ValueError) as e:
+            self.log(f"Watch stream interrupted: {e}")
+        return self.monitoring_done()
+
+    def poll_argo_syncs(self):
+        # Poll the apps that are still syncing. The interval starts short, backs off while nothing changes,
+        # and resets whenever something does.
         argo_api_status_path = "/api/v1/applications/{application_name}"
+        min_interval = float(env.get('ARGOCD_POLL_MIN', 2))
+        max_interval = float(env.get('ARGOCD_POLL_MAX', 15))
+        interval = min_interval
+
+        while not self.monitoring_done():
+            changed = False
+            with tracer.span("monitor.poll", cluster = self.argocd_server) as trace:
+                pending = [ app_name for app_name in self.in_flight if app_name not in self.app_states or self.sync_in_progress(self.app_states[app_name]) ]
+                trace.set(pending = len(pending))
+                for app_name in pending:
+                    self.log(f"Checking app sync status for {app_name}.")
+                    app_status_endpoint_url = self.argocd_server + argo_api_status_path.format(application_name = app_name)
+                    app_status = self.http.get(app_status_endpoint_url, headers = self.argocd_headers, verify = False, endpoint = "GET /api/v1/applications/{app}")
+                    if app_status.status_code > 299:
+                        self.log(f"Unable to get status for {app_name}: {app_status.text}")
+                        continue
+                    changed = self.observe(app_status.json()) or changed
+                trace.set(changed = changed)
+
+            if self.monitoring_done():
+                break
+            interval = min_interval if changed else min(interval * 2, max_interval)
+            sleep(interval)
+        return
+
+    def monitor_argo_syncs(self, apps):
+        # Follow apps until their syncs are done, or with fail fast until one of them fails.
+        self.in_flight = apps
+        if not self.watch_argo_syncs():
+            self.log("Falling back to polling for sync status.")
+            self.poll_argo_syncs()
+        return
 
+    def report_argo_syncs(self, synced):
+        # Dump final status to logs from the last observed state, no need to fetch it again.
         Success = True
-        while True:
-            Degraded = False
-            syncs_in_progress = False
-            for app_name in self.apps_to_sync:
-                print(f"Checking app sync status for {app_name}.", file=sys.stderr)
-                app_status_endpoint_url = self.argocd_server + argo_api_status_path.format(application_name = app_name)
-                app_status = requests.get(app_status_endpoint_url, headers = self.argocd_headers, verify = False)
-
-                # Check to see if there is a sync in progress.
-                if app_status.json()['status']['sync']['status'] == "Progressing":
-                    syncs_in_progress = True
-                    print(f"Sync in progress for {app_name}. {app_status.json()['status']['sync']['status']}.", file=sys.stderr)
-                else:
-                    print(f"Sync complete for {app_name}. {app_status.json()['status']['sync']['status']}.", file=sys.stderr)
-                    # If the sync is complete, check application status and catch unhealthy applications.
-                    if app_status.json()['status']['health']['status'] != "Healthy":
-                        Degraded = True
-                    print(f"Health status: {app_status.json()['status']['health']['status']}.", file=sys.stderr)
-
-            # Check to see if all applications are synced.
-            # If an application is degraded, report an unsuccessful sync.
-            if not syncs_in_progress:
-                if Degraded:
-                    Success = False
-                break
-            sleep(15)
-
-        # All syncs are done.
-        # Dump final status to logs now that syncs are completed.
-        for app_name in self.apps_to_sync:
-            app_status_endpoint_url = self.argocd_server + argo_api_status_path.format(application_name = app_name)
-            app_status = requests.get(app_status_endpoint_url, headers = self.argocd_headers, verify = False)
-            if app_status.json()['status']['health']['status'] != "Healthy":
-                for resource in app_status.json()['status']['resources']:
-                    print(resource['kind'], resource['name'], file=sys.stderr)
-                    for i in resource['health'].keys():
-                        print(" ", i, ":", resource['health'][i], file=sys.stderr)
+        for app_name in synced:
+            app = self.app_states.get(app_name, {})
+            if self.health_status(app) != "Healthy":
+                Success = False
+                for resource in app.get('status', {}).get('resources', []):
+                    self.log(resource['kind'], resource['name'])
+                    for i in resource.get('health', {}).keys():
+                        self.log(" ", i, ":", resource['health'][i])
             else:
-                print(app_name, "is healthy.", file=sys.stderr)
+                self.log(app_name, "is healthy.")
 
-        print("", file=sys.stderr)
+        self.log("")
         if Success:
-            print("Sync Successful.", file=sys.stderr)
+            self.log("Sync Successful.")
             return Success
         else:
-            print("Sync Completed with errors.", file=sys.stderr)
+            self.log("Sync Completed with errors.")
             return Success
 
 
-if __name__ == "__main__":
-    dir_path = path.dirname(path.realpath(__file__))
+class argocd_fanout:
+    # Deploys to several ArgoCD clusters at once, each one a full argocd_syncer run
+    # (discovery, sync, monitor) with its own ARGOCD_SYNC_CONCURRENCY limit.
+    def __init__(self, targets):
+        self.targets = targets
+        self.cluster_concurrency = max(1, int(env.get('ARGOCD_CLUSTER_CONCURRENCY', len(targets))))
+        self.results = {}
+        return
+
+    def deploy_target(self, target):
+        argocd_server, environment = target
+        summary = { "apps": 0, "failed_to_start": 0, "unhealthy": 0, "error": None }
+        try:
+            x = argocd_syncer(argocd_server, environment, label = argocd_server)
+            summary['apps'] = len(x.apps_to_sync)
+            Success = x.execute()
+            summary['failed_to_start'] = len(x.sync_errors)
+            summary['unhealthy'] = len([ app for app in getattr(x, 'app_states', {}).values() if x.health_status(app) != "Healthy" ])
+        except SystemExit:
+            # argocd_syncer exits on fatal errors like an unreachable server or no apps to sync.
+            Success, summary['error'] = False, "aborted"
+        except Exception as e:
+            print(f"[{argocd_server}] {e}", file=sys.stderr)
+            Success, summary['error'] = False, type(e).__name__
+        summary['success'] = Success
+        return summary
 
-    if args.imageupdate:
-        x = deployment_updater()
-        x.update_deployments()
-        exit()
-    elif args.secretname:
-        print( re.sub(r'\W+', '', env['ARGOCD_SERVER'].format(env = env['ENVIRONMENT']).replace("https://","").replace("/","")).upper() )
-        exit()
-    elif args.cr_json:
-        x = templater()
-        x.cr_template(f"{dir_path}{sep}cr.json")
-        exit()
-    elif args.cr_update:
-        x = templater()
-        x.implementation_plan_update(f"{dir_path}{sep}imp.json")
-        exit()
-    elif args.deploy:
-        x = argocd_syncer()
-        if x.execute():
+    def execute(self):
+        # Returns an exit code with bit i set when target i failed. Bit 6 covers the 7th target and every one
+        # after it, so the code stays below 128, which shells and Actions would read as a signal.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = self.cluster_concurrency) as pool:
+            for target, summary in zip(self.targets, pool.map(with_request_output(self.deploy_target), self.targets)):
+                self.results[target[0]] = summary
+
+        exit_code = 0
+        print("", file=sys.stderr)
+        print("Deployment summary:", file=sys.stderr)
+        for i, (argocd_server, environment) in enumerate(self.targets):
+            summary = self.results[argocd_server]
+            if summary['success']:
+                status = "succeeded"
+            else:
+                status = "FAILED"
+                exit_code |= 1 << min(i, 6)
+            details = f"{summary['apps']} apps, {summary['failed_to_start']} failed to start, {summary['unhealthy']} unhealthy"
+            if summary['error'] is not None:
+                details += f", {summary['error']}"
+            print(f"  {environment} {argocd_server}: {status} ({details})", file=sys.stderr)
+        return exit_code
+
+
+def cmd_imageupdate(args):
+    x = deployment_updater()
+    return x.update_deployments()
+
+def cmd_rebuild_index(args):
+    files = ( file for file in walk_files(ignore_dirs(deployment_updater.IGNORE_DIRS)) if file.lower().endswith((".yml", ".yaml")) )
+    open_property_index(index_path()).rebuild(files, args.workers if args.workers > 0 else cpu_count())
+    return 0
+
+def cmd_secretname(args):
+    print( secret_name(env['ARGOCD_SERVER'].format(env = env['ENVIRONMENT'])) )
+    return 0
+
+def cmd_cr_json(args):
+    if args.batch:
+        return cr_batch(args.batch, args.batch_out).generate()
+    x = templater()
+    x.cr_template(f"{path.dirname(path.realpath(__file__))}{sep}cr.json")
+    return 0
+
+def cmd_cr_update(args):
+    x = templater()
+    x.implementation_plan_update(f"{path.dirname(path.realpath(__file__))}{sep}imp.json")
+    return 0
+
+def cmd_deploy(args):
+    if len(argocd_targets()) > 1:
+        exit_code = argocd_fanout(argocd_targets()).execute()
+        get_http_client().print_stats()
+        if exit_code == 0:
             print("Deployment suceeded.")
-            exit(0)
         else:
             print("Deployment completed with errors. See Logs.")
-            exit(1)
-    elif args.merge:
-        x = pr_merger()
-        exit(x.check_and_merge())
+        return exit_code
+
+    x = argocd_syncer()
+    Success = x.execute()
+    get_http_client().print_stats()
+    if Success:
+        print("Deployment suceeded.")
+        return 0
+    else:
+        print("Deployment completed with errors. See Logs.")
+        return 1
+
+def cmd_merge(args):
+    if args.prs or args.prs_file:
+        x = merge_queue(merge_queue_entries(args.prs, args.prs_file), args.merge_concurrency)
+        isError = x.execute(args.results)
+        get_http_client().print_stats()
+        return isError
+    x = pr_merger()
+    isError = x.check_and_merge()
+    get_http_client().print_stats()
+    return isError
+
+class shared_lock:
+    # Any number of shared holders, or a single exclusive one.
+    def __init__(self):
+        self.condition = Condition()
+        self.shared = 0
+        self.exclusive = False
+        return
+
+    def acquire(self, exclusive):
+        with self.condition:
+            while self.exclusive or (exclusive and self.shared > 0):
+                self.condition.wait()
+            if exclusive:
+                self.exclusive = True
+            else:
+                self.shared += 1
+        return
+
+    def release(self, exclusive):
+        with self.condition:
+            if exclusive:
+                self.exclusive = False
+            else:
+                self.shared -= 1
+            self.condition.notify_all()
+        return
+
+class thread_stream:
+    # Stands in for sys.stdout/sys.stderr while serving, so each request's output is captured
+    # separately. Writes from threads that aren't handling a request go to fallback.
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.local = local()
+        return
+
+    def write(self, text):
+        return (getattr(self.local, 'buffer', None) or self.fallback).write(text)
+
+    def flush(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.fallback.flush()
+        return
+
+def with_request_output(function):
+    # Wraps function so pool threads write where the calling thread does. Output is captured per
+    # thread while serving, so without this a request's worker threads would print to the real stderr.
+    streams = [ stream for stream in (sys.stdout, sys.stderr) if isinstance(stream, thread_stream) ]
+    buffers = [ getattr(stream.local, 'buffer', None) for stream in streams ]
+    if len(streams) == 0:
+        return function
+    def run(*a, **kw):
+        saved = [ getattr(stream.local, 'buffer', None) for stream in streams ]
+        for stream, buffer in zip(streams, buffers):
+            stream.local.buffer = buffer
+        try:
+            return function(*a, **kw)
+        finally:
+            for stream, buffer in zip(streams, saved):
+                stream.local.buffer = buffer
+    return run
+
+class crgen_server:
+    # Long lived worker answering JSON-RPC 2.0 requests, one JSON object per line, on stdin/stdout
+    # or a Unix socket. Compiled templates, property indexes and the HTTP connection pool stay warm
+    # between requests.
+    #
+    #   {"jsonrpc": "2.0", "id": 1, "method": "cr-json", "params": {"env": {"NEW_VALUE": "v2"}, "args": {"simple": true}}}
+    #
+    # "env" overrides environment variables and "args" the subcommand's options. cr-json, cr-update and
+    # secretname build their result from the overrides alone, so they run concurrently. imageupdate,
+    # rebuild-index, deploy and merge read the process environment, so they run one at a time with
+    # the overrides applied, and so does cr-json with "batch" or "batch_out", as on the command line.
+    # The result holds the exit code and the request's captured stdout/stderr.
+    SHARED = [ "cr-json", "cr-update", "secretname" ]
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.lock = shared_lock()
+        self.write_lock = Lock()
+        self.parser = build_parser()
+        return
+
+    def options_for(self, method, params):
+        options, _ = self.parser.parse_known_args([ method ])
+        for name, default in vars(args).items():
+            if not hasattr(options, name):
+                setattr(options, name, default)
+        for name, value in params.get('args', {}).items():
+            setattr(options, name.replace("-", "_"), value)
+        return options
+
+    def batch_request(self, method, options):
+        return method == "cr-json" and bool(getattr(options, 'batch', None) or getattr(options, 'batch_out', None))
+
+    def run_shared(self, method, overrides, options):
+        if method == "secretname":
+            variables = dict(env)
+            variables.update(overrides)
+            return { "name": secret_name(variables['ARGOCD_SERVER'].format(env = variables['ENVIRONMENT'])) }
+        x = templater(overrides, simple = options.simple)
+        if method == "cr-json":
+            return { "cr": x.generate_cr_template() }
+        return { "plan": x.generate_implementation_plan() }
+
+    def run_exclusive(self, method, overrides, options):
+        saved = dict(env)
+        env.update(overrides)
+        try:
+            set_args(options)
+            return { "exit_code": int(COMMANDS[method](options) or 0) }
+        finally:
+            env.clear()
+            env.update(saved)
+
+    def call(self, method, params):
+        overrides = { key: str(value) for key, value in params.get('env', {}).items() }
+        options = self.options_for(method, params)
+        exclusive = method not in self.SHARED or self.batch_request(method, options)
+
+        stdout, stderr = StringIO(), StringIO()
+        sys.stdout.local.buffer, sys.stderr.local.buffer = stdout, stderr
+        self.lock.acquire(exclusive)
+        try:
+            if exclusive:
+                result = self.run_exclusive(method, overrides, options)
+            else:
+                result = self.run_shared(method, overrides, options)
+                result['exit_code'] = 0
+        except SystemExit as e:
+            code = e.code
+            if not isinstance(code, int):
+                print(code, file=sys.stderr)
+                code = 0 if code is None else 1
+            result = { "exit_code": code }
+        finally:
+            self.lock.release(exclusive)
+            sys.stdout.local.buffer, sys.stderr.local.buffer = None, None
+        result['stdout'] = stdout.getvalue()
+        result['stderr'] = stderr.getvalue()
+        return result
+
+    def handle(self, line):
+        # Returns the response line for one request line, or None for a notification.
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({ "jsonrpc": "2.0", "id": None, "error": { "code": -32700, "message": f"Parse error: {e}" } })
+        if not isinstance(request, dict):
+            return json.dumps({ "jsonrpc": "2.0", "id": None, "error": { "code": -32600, "message": "Invalid Request" } })
+
+        request_id = request.get('id')
+        method = request.get('method')
+        params = request.get('params') or {}
+        if method not in COMMANDS.keys() or method == "serve":
+            response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": -32601, "message": f"Method not found: {method}" } }
+        elif not isinstance(params, dict) or not isinstance(params.get('env', {}), dict) or not isinstance(params.get('args', {}), dict):
+            response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": -32602, "message": "params must be an object with optional 'env' and 'args' objects" } }
+        elif method == "cr-json" and params.get('args', {}).get('batch') == "-":
+            # The server's stdin carries requests, not a manifest.
+            response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": -32602, "message": "batch can't be '-' when serving, pass a manifest path" } }
+        else:
+            try:
+                response = { "jsonrpc": "2.0", "id": request_id, "result": self.call(method, params) }
+            except Exception as e:
+                response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": -32000, "message": f"{type(e).__name__}: {e}" } }
+
+        if "id" not in request:
+            return None
+        return json.dumps(response)
+
+    def serve_stdio(self):
+        from concurrent.futures import ThreadPoolExecutor
+        # Responses go to the real stdout; anything else printed while serving is redirected to stderr.
+        protocol = sys.stdout
+        sys.stdout = thread_stream(sys.stderr)
+        sys.stderr = thread_stream(sys.stderr)
+
+        def respond(line):
+            response = self.handle(line)
+            if response is not None:
+                with self.write_lock:
+                    protocol.write(response + "\n")
+                    protocol.flush()
+
+        with ThreadPoolExecutor(max_workers = self.threads) as pool:
+            for line in sys.stdin:
+                if line.strip():
+                    pool.submit(respond, line)
+        return 0
+
+    def serve_socket(self, socket_path):
+        import socketserver
+        server = self
+
+        class handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        response = server.handle(line)
+                        if response is not None:
+                            self.wfile.write((response + "\n").encode())
+                            self.wfile.flush()
+
+        sys.stdout = thread_stream(sys.stdout)
+        sys.stderr = thread_stream(sys.stderr)
+        if path.exists(socket_path):
+            from os import remove
+            remove(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, handler) as unix_server:
+            unix_server.daemon_threads = True
+            print(f"Serving on {socket_path}.", file=sys.stderr)
+            unix_server.serve_forever()
+        return 0
+
+def cmd_serve(args):
+    x = crgen_server(args.threads)
+    if args.socket:
+        return x.serve_socket(args.socket)
+    return x.serve_stdio()
+
+COMMANDS = {
+    "imageupdate": cmd_imageupdate,
+    "rebuild-index": cmd_rebuild_index,
+    "secretname": cmd_secretname,
+    "cr-json": cmd_cr_json,
+    "cr-update": cmd_cr_update,
+    "deploy": cmd_deploy,
+    "merge": cmd_merge,
+    "serve": cmd_serve
+}
+
+# Third party modules each subcommand ends up importing. crbench.py uses this for its startup benchmark.
+COMMAND_IMPORTS = {
+    "imageupdate": [ "ruamel.yaml" ],
+    "rebuild-index": [ "ruamel.yaml", "concurrent.futures.process" ],
+    "secretname": [],
+    "cr-json": [ "ruamel.yaml" ],
+    "cr-update": [ "ruamel.yaml" ],
+    "deploy": [ "requests", "ruamel.yaml", "concurrent.futures.thread" ],
+    "merge": [ "requests" ],
+    "serve": [ "concurrent.futures.thread" ]
+}
+
+# The old single-dash-mode flags, in the precedence the old if/elif chain gave them.
+LEGACY_MODES = {
+    "--imageupdate": "imageupdate",
+    "--rebuild-index": "rebuild-index",
+    "--secretname": "secretname",
+    "--cr_json": "cr-json",
+    "--cr_update": "cr-update",
+    "--deploy": "deploy",
+    "--merge": "merge"
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Manifest updates, CR generation, ArgoCD deploys and PR merges for GitOps repositories.")
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument("--verbose", help="More/wordier output.", action="store_true")
+    common.add_argument("--simple", help="Omit custom fields and stuff when creating the CR.", action="store_true")
+    workers = argparse.ArgumentParser(add_help = False)
+    workers.add_argument("--workers", help="Worker processes. 0 means one per CPU.", type=int, default=int(env.get('WORKERS', 1)))
+
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    subparser = subparsers.add_parser("imageupdate", parents = [ common, workers ], help="Update image tags for deployment.")
+    subparser.add_argument("--index", help="Use the persistent property index (path from CRGEN_INDEX).", action="store_true")
+    subparser.add_argument("--dry-run", help="Print a unified diff of what would change instead of writing files.", action="store_true")
+    subparser.add_argument("--changed-files", help="Write the paths of changed files to this file, one per line.")
+    subparser.add_argument("--source", help="Where candidate files come from: the working tree, or the files tracked in the git index.", choices=[ "walk", "git" ], default=env.get('CRGEN_FILE_SOURCE', 'walk'))
+    subparser.add_argument("--changed-since", help="Only consider files changed between this git ref and HEAD.", default=env.get('CHANGED_SINCE') or None)
+    subparsers.add_parser("rebuild-index", parents = [ common, workers ], help="Rebuild the persistent property index from scratch.")
+    subparsers.add_parser("secretname", parents = [ common ], help="Just spit out name of argocd server.")
+    subparser = subparsers.add_parser("cr-json", parents = [ common ], help="Generate Initial CR JSON")
+    subparser.add_argument("--batch", help="Generate one CR per row of this JSON Lines/CSV manifest ('-' for stdin).")
+    subparser.add_argument("--batch-out", help="With --batch, write cr-<row>.json files into this directory instead of JSON Lines on stdout.")
+    subparsers.add_parser("cr-update", parents = [ common ], help="Generate CR JSON for Update (with callback URL and PR/CR number)")
+    subparsers.add_parser("deploy", parents = [ common ], help="ArgoCD Sync. Monitor Sync Status.")
+    subparser = subparsers.add_parser("merge", parents = [ common ], help="Merge currently active Pull Request")
+    subparser.add_argument("--prs", help="Merge queue: comma separated PR numbers, each optionally PR:CR. Defaults to PR_NUMBERS.", default=env.get('PR_NUMBERS') or None)
+    subparser.add_argument("--prs-file", help="Merge queue: JSON list of PR numbers or {\"pr\", \"cr\"} objects, or a {PR: CR} mapping.")
+    subparser.add_argument("--merge-concurrency", help="Merge queue: PRs checked, and base branches merged, at once.", type=int, default=int(env.get('MERGE_CONCURRENCY', 4)))
+    subparser.add_argument("--results", help="Merge queue: write one JSON line per PR with its outcome to this file.")
+    subparser = subparsers.add_parser("serve", parents = [ common ], help="Answer JSON-RPC requests for the other subcommands, keeping caches and connections warm.")
+    subparser.add_argument("--socket", help="Listen on this Unix socket instead of stdin/stdout.")
+    subparser.add_argument("--threads", help="Requests handled at once on stdin/stdout.", type=int, default=4)
+    return parser
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = build_parser()
+
+    legacy = [ flag for flag in LEGACY_MODES if flag in argv ]
+    if len(legacy) > 0:
+        # "crgen.py --imageupdate --verbose" is "crgen.py imageupdate --verbose". Options the old flat
+        # parser accepted for every mode are ignored where the subcommand doesn't use them.
+        argv = [ LEGACY_MODES[legacy[0]] ] + [ a for a in argv if a not in LEGACY_MODES ]
+        options, _ = parser.parse_known_args(argv)
+    else:
+        options = parser.parse_args(argv)
+
+    for name, default in vars(args).items():
+        if not hasattr(options, name):
+            setattr(options, name, default)
+    set_args(options)
+    return run_command(options)
+
+def run_command(options):
+    # The whole subcommand is the root span; with CRGEN_PROFILE it also runs under cProfile.
+    profile_path = env.get('CRGEN_PROFILE')
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        with tracer.span("command", command = options.command):
+            if profiler is not None:
+                return profiler.runcall(COMMANDS[options.command], options)
+            return COMMANDS[options.command](options)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile_path)
+            print(f"Wrote profile to {profile_path}.", file=sys.stderr)
+        tracer.export(options.command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
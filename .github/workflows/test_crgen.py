@@ -0,0 +1,224 @@
+import unittest
+import tempfile
+from unittest import mock
+from os import environ as env, path, symlink
+
+import crgen
+
+# Run from this directory: python -m unittest test_crgen
+
+class patch_scalars_test(unittest.TestCase):
+    def setUp(self):
+        variables = { "YAML_PROPERTY": "image.tag", "NEW_VALUE": "v2", "ENVIRONMENT": "test", "SUBFOLDER_FILTER": "*", "FILENAME_FILTER": "*" }
+        with mock.patch.dict(env, variables):
+            self.updater = crgen.deployment_updater()
+        return
+
+    def patch(self, text, expression, new_value = "v2"):
+        # What patch_scalars makes of text for every match of expression, None when it falls back to a full dump.
+        documents = list(self.updater.yaml.load_all(text))
+        matches = crgen.match_property_paths(documents, [ crgen.property_path(expression) ])[0]
+        self.assertTrue(len(matches) > 0, f"{expression} doesn't match")
+        return self.updater.patch_scalars(text, [ (parent, key) for _, parent, key, _ in matches ], new_value)
+
+    def test_plain_scalar(self):
+        self.assertEqual(self.patch("image:\n  repo: r\n  tag: v1\nname: x\n", "image.tag"), "image:\n  repo: r\n  tag: v2\nname: x\n")
+
+    def test_quoted_scalars(self):
+        self.assertEqual(self.patch("image:\n  tag: 'v1'\n", "image.tag"), "image:\n  tag: v2\n")
+        self.assertEqual(self.patch('image:\n  tag: "v\\"1" # note\n', "image.tag"), "image:\n  tag: v2 # note\n")
+        self.assertEqual(self.patch("image:\n  tag: 'it''s'\n", "image.tag"), "image:\n  tag: v2\n")
+        # A new value that needs quoting is quoted the way a dump would quote it.
+        self.assertEqual(self.patch("image:\n  tag: v1\n", "image.tag", "1.0"), "image:\n  tag: '1.0'\n")
+
+    def test_block_and_multi_line_scalars_fall_back(self):
+        self.assertIsNone(self.patch("image:\n  tag: |\n    v1\n", "image.tag"))
+        self.assertIsNone(self.patch("image:\n  tag: >-\n    v1\n", "image.tag"))
+        self.assertIsNone(self.patch("image:\n  tag: v1\n    continued\n", "image.tag"))
+        self.assertIsNone(self.patch("image:\n  tag: 'v1\n    continued'\n", "image.tag"))
+        self.assertIsNone(self.patch("image: { tag: v1 }\n", "image.tag"))
+
+    def test_list_items(self):
+        self.assertEqual(self.patch("tags:\n- a\n- b # keep\n", "tags[1]"), "tags:\n- a\n- v2 # keep\n")
+        self.assertEqual(self.patch("tags:\n  - a\n  - b\n", "tags[-1]"), "tags:\n  - a\n  - v2\n")
+        text = "containers:\n- name: api\n  image: api:v1\n- name: web\n  image: web:v1\n"
+        self.assertEqual(self.patch(text, "containers[name=api].image", "api:v2"), text.replace("api:v1", "api:v2"))
+        self.assertEqual(self.patch(text, "containers[*].image", "x:v2"), "containers:\n- name: api\n  image: x:v2\n- name: web\n  image: x:v2\n")
+
+    def test_comments(self):
+        text = "# header\nimage:\n  # the tag\n  tag: v1   # pinned\n  # trailing\nname: x\n"
+        self.assertEqual(self.patch(text, "image.tag"), text.replace("v1   # pinned", "v2   # pinned"))
+        # A # inside the value isn't a comment.
+        self.assertEqual(self.patch("image:\n  tag: v1#x\n", "image.tag"), "image:\n  tag: v2\n")
+
+    def test_crlf(self):
+        self.assertEqual(self.patch("image:\r\n  tag: v1\r\n  repo: r\r\n", "image.tag"), "image:\r\n  tag: v2\r\n  repo: r\r\n")
+        self.assertEqual(self.patch("image:\r\n  tag: 'v1' # c\r\n", "image.tag"), "image:\r\n  tag: v2 # c\r\n")
+
+    def test_multiple_documents(self):
+        text = "image:\n  tag: v1\n---\nother: x\n---\nimage:\n  tag: v0\n"
+        self.assertEqual(self.patch(text, "image.tag"), "image:\n  tag: v2\n---\nother: x\n---\nimage:\n  tag: v2\n")
+
+    def test_merge_keys_fall_back(self):
+        # tag only exists in svc through the merge key, so there's nothing in svc to patch.
+        text = "base: &base\n  tag: v1\n  repo: r\nsvc:\n  <<: *base\n  name: a\n"
+        self.assertIsNone(self.patch(text, "svc.tag"))
+        # A key of svc's own next to the merge key is patched in place.
+        text = "base: &base\n  repo: r\nsvc:\n  <<: *base\n  tag: v1\n"
+        self.assertEqual(self.patch(text, "svc.tag"), "base: &base\n  repo: r\nsvc:\n  <<: *base\n  tag: v2\n")
+
+    def test_anchors_and_aliases_fall_back(self):
+        self.assertIsNone(self.patch("image:\n  tag: &t v1\nother: *t\n", "image.tag"))
+        self.assertIsNone(self.patch("tag: &t v1\nimage:\n  tag: *t\n", "image.tag"))
+        self.assertIsNone(self.patch("image:\n  tag: !!str v1\n", "image.tag"))
+
+    def test_patch_matches_full_dump(self):
+        # Whatever is patched in place has to load the same as the full dump would have written it.
+        text = "a:\n  b: 1 # one\n  c:\n  - x: 'q'\n    y: z\n---\na:\n  b: 2\n"
+        for expression in [ "a.b", "a.c[0].x", "a.c[x=q].y" ]:
+            patched = self.patch(text, expression, "new")
+            documents = list(self.updater.yaml.load_all(text))
+            for _, parent, key, _ in crgen.match_property_paths(documents, [ crgen.property_path(expression) ])[0]:
+                parent[key] = "new"
+            self.assertEqual(list(self.updater.yaml.load_all(patched)), documents)
+
+
+class atomic_write_test(unittest.TestCase):
+    def test_writes_through_symlinks(self):
+        with tempfile.TemporaryDirectory() as root:
+            real, link = path.join(root, "real.yml"), path.join(root, "link.yaml")
+            with open(real, 'w') as f:
+                f.write("tag: v1\n")
+            symlink("real.yml", link)
+            crgen.atomic_write(link, "tag: v2\n")
+            self.assertTrue(path.islink(link))
+            with open(real) as f:
+                self.assertEqual(f.read(), "tag: v2\n")
+
+
+class property_path_test(unittest.TestCase):
+    DOCUMENTS = """
+image:
+  repository: registry/api
+  tag: v1
+metadata:
+  labels:
+    app.kubernetes.io/version: v1
+    "weird[key]": x
+spec:
+  template:
+    spec:
+      containers:
+      - name: api
+        image: api:v1
+        ports: [ 80, 443 ]
+      - name: web
+        image: web:v1
+      - name: "1"
+        image: one:v1
+---
+- tag: a
+- tag: b
+---
+plain scalar
+---
+services:
+  api:
+    image:
+      tag: v1
+  web:
+    image:
+      tag: v1
+      extra:
+      - tag: nested
+"""
+
+    EXPRESSIONS = [
+        "image.tag", "image", "tag", "image.missing", "missing.tag",
+        "metadata.labels['app.kubernetes.io/version']", 'metadata.labels["app.kubernetes.io/version"]', "metadata.labels['weird[key]']",
+        "metadata.labels.app", "metadata.labels.*",
+        "spec.template.spec.containers[*].image", "spec.template.spec.containers[0].image", "spec.template.spec.containers[2].image",
+        "spec.template.spec.containers[3].image", "spec.template.spec.containers[-1].image", "spec.template.spec.containers[-3].name",
+        "spec.template.spec.containers[-4].name", "spec.template.spec.containers[name=web].image", "spec.template.spec.containers[name='api'].image",
+        "spec.template.spec.containers[name=1].image", "spec.template.spec.containers[name=db].image", "spec.template.spec.containers[*].ports[1]",
+        "spec.template.spec.containers[image=api:v1].name", "[0].tag", "[-1].tag", "[*].tag", "[tag=b].tag", "[2].tag",
+        "services.*.image.tag", "services.*.image.extra[*].tag", "*.api.image", "*", "*.*", "services.api.image.tag.deeper",
+    ]
+
+    def steps(self, expression):
+        return crgen.property_path(expression).steps
+
+    def test_keys(self):
+        self.assertEqual(self.steps("image.tag"), [ ("key", "image"), ("key", "tag") ])
+        self.assertEqual(self.steps("tag"), [ ("key", "tag") ])
+        self.assertEqual(self.steps("*.tag"), [ ("any_key",), ("key", "tag") ])
+        self.assertEqual(self.steps("a b.c-d"), [ ("key", "a b"), ("key", "c-d") ])
+
+    def test_quoted_keys(self):
+        self.assertEqual(self.steps("labels['app.kubernetes.io/version']"), [ ("key", "labels"), ("key", "app.kubernetes.io/version") ])
+        self.assertEqual(self.steps('labels["a.b"].c'), [ ("key", "labels"), ("key", "a.b"), ("key", "c") ])
+        self.assertEqual(self.steps("['a.b']"), [ ("key", "a.b") ])
+        self.assertEqual(self.steps("labels['weird[key]']"), [ ("key", "labels"), ("key", "weird[key]") ])
+
+    def test_indexes_and_selectors(self):
+        self.assertEqual(self.steps("containers[*].image"), [ ("key", "containers"), ("all",), ("key", "image") ])
+        self.assertEqual(self.steps("containers[0].image"), [ ("key", "containers"), ("index", 0), ("key", "image") ])
+        self.assertEqual(self.steps("containers[-1].image"), [ ("key", "containers"), ("index", -1), ("key", "image") ])
+        self.assertEqual(self.steps("[0][1]"), [ ("index", 0), ("index", 1) ])
+        self.assertEqual(self.steps("containers[name=api].image"), [ ("key", "containers"), ("select", "name", "api"), ("key", "image") ])
+        self.assertEqual(self.steps("containers[name = 'api'].image"), [ ("key", "containers"), ("select", "name", "api"), ("key", "image") ])
+        self.assertEqual(self.steps('containers[name="a=b"]'), [ ("key", "containers"), ("select", "name", "a=b") ])
+
+    def test_leaf_key(self):
+        self.assertEqual(crgen.property_path("containers[name=api].image").leaf_key, "image")
+        self.assertEqual(crgen.property_path("labels['a.b']").leaf_key, "a.b")
+        self.assertEqual(crgen.property_path("tags[0]").leaf_key, "tags")
+        self.assertIsNone(crgen.property_path("[0][*]").leaf_key)
+        self.assertIsNone(crgen.property_path("*").leaf_key)
+
+    def test_invalid(self):
+        for expression in [ "", ".a", "a.", "a..b", "a.[0]", "a[", "a]", "a[1", "a[]", "a[x]", "a[ 1 ]", "a[0]b", "a['b']c", "a[0]..b" ]:
+            with self.assertRaises(Exception, msg = expression):
+                crgen.property_path(expression)
+
+    def test_negative_indexes(self):
+        documents = list(crgen.round_trip_yaml().load_all("tags: [ a, b, c ]\n"))
+        labels = lambda expression: [ m[3] for m in crgen.match_property_paths(documents, [ crgen.property_path(expression) ])[0] ]
+        self.assertEqual(labels("tags[-1]"), [ "tags[2]" ])
+        self.assertEqual(labels("tags[-3]"), [ "tags[0]" ])
+        self.assertEqual(labels("tags[-4]"), [])
+        self.assertEqual(labels("tags[3]"), [])
+
+    def test_matches(self):
+        documents = list(crgen.round_trip_yaml().load_all(self.DOCUMENTS))
+        paths = [ crgen.property_path(e) for e in [ "spec.template.spec.containers[name=web].image", "[*].tag", "services.*.image.tag" ] ]
+        matches = crgen.match_property_paths(documents, paths)
+        self.assertEqual([ (m[0], m[3], m[1][m[2]]) for m in matches[0] ], [ (0, "spec.template.spec.containers[1].image", "web:v1") ])
+        self.assertEqual([ (m[0], m[3]) for m in matches[1] ], [ (1, "[0].tag"), (1, "[1].tag") ])
+        self.assertEqual([ (m[0], m[3]) for m in matches[2] ], [ (3, "services.api.image.tag"), (3, "services.web.image.tag") ])
+
+    def test_could_match_agrees_with_matching(self):
+        # The index may only skip files that really don't match: whatever match_property_paths finds in a
+        # document, could_match has to allow from that document's property paths, spelled the same way.
+        texts = self.DOCUMENTS.split("---\n")
+        paths = [ crgen.property_path(e) for e in self.EXPRESSIONS ]
+        for text in texts:
+            documents = list(crgen.round_trip_yaml().load_all(text))
+            known = [ p for document in documents for p in crgen.property_index.property_paths(document) ]
+            for expression, path, found in zip(self.EXPRESSIONS, paths, crgen.match_property_paths(documents, paths)):
+                with self.subTest(expression = expression, document = text[:20]):
+                    if len(found) > 0:
+                        self.assertTrue(path.could_match(known))
+                    elif self.exact(path):
+                        self.assertFalse(path.could_match(known))
+                    for _, _, _, location in found:
+                        self.assertIn(location, known)
+                        self.assertTrue(path.index_pattern.fullmatch(location))
+
+    def exact(self, path):
+        # Without selectors and negative indexes the index knows the answer, not just that it might match.
+        return all( step[0] != "select" and not (step[0] == "index" and step[1] < 0) for step in path.steps )
+
+
+if __name__ == "__main__":
+    unittest.main()